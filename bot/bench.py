@@ -0,0 +1,51 @@
+"""Startup and yt-dlp construction timings: python -m bot.bench"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+_RUNS = 5
+_CALLS = 50
+
+
+def _import_ms(module: str) -> float:
+    """Median wall time of importing *module* in a fresh interpreter."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(_RUNS):
+        out = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, env=os.environ, check=True,
+        )
+        samples.append(float(out.stdout.strip()) * 1000)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    print(f"import bot.main: {_import_ms('bot.main'):.0f} ms")
+    print(f"import yt_dlp:   {_import_ms('yt_dlp'):.0f} ms")
+
+    import yt_dlp
+
+    from bot.ytdl_workers import ydl_pool
+
+    opts = {"quiet": True, "no_warnings": True}
+
+    started = time.perf_counter()
+    for _ in range(_CALLS):
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            ydl.get_info_extractor("Youtube")
+    fresh = (time.perf_counter() - started) / _CALLS * 1000
+
+    ydl_pool.warm(opts)
+    started = time.perf_counter()
+    for _ in range(_CALLS):
+        with ydl_pool.borrow(opts, progress_hook=print, pp_hook=print) as ydl:
+            ydl.get_info_extractor("Youtube")
+    pooled = (time.perf_counter() - started) / _CALLS * 1000
+
+    print(f"YoutubeDL per call: fresh {fresh:.2f} ms, pooled {pooled:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
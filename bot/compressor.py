@@ -0,0 +1,547 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import shutil
+import subprocess
+import time
+from functools import partial
+
+from bot.config import ENCODE_WORKERS, FFMPEG_PATH
+from bot.ffmpeg import progress_text, run_ffmpeg, text_reporter
+from bot.scheduler import observe_encode, scheduler
+
+logger = logging.getLogger(__name__)
+
+_FFPROBE_PATH = FFMPEG_PATH.replace("ffmpeg", "ffprobe") if "ffmpeg" in FFMPEG_PATH else "ffprobe"
+
+AUDIO_EXTS = (".mp3", ".m4a", ".aac", ".ogg", ".opus")
+
+# MP4 muxing overhead: fixed moov/ftyp part plus a sample-table entry per packet
+_CONTAINER_FIXED_BYTES = 64 * 1024
+_BYTES_PER_PACKET = 12
+_AAC_PACKETS_PER_SEC = 47  # 48 kHz / 1024 samples per frame
+# Headroom for rate-control error; the post-encode size check stays as a safety net
+_SIZE_MARGIN = 0.02
+
+_MIN_VIDEO_KBPS = 100
+_MIN_AUDIO_KBPS = 48
+_DEFAULT_AUDIO_KBPS = 128
+# VBV cap relative to the average bitrate: limits peaks without hurting quality much
+_MAXRATE_FACTOR = 1.5
+_BUFSIZE_FACTOR = 2.0
+
+# Sample-encode predictor: a few short slices spread across the file
+_SAMPLE_COUNT = 3
+_SAMPLE_SECONDS = 4.0
+_PROBE_CRF = 26
+# x264 output roughly halves for every +6 CRF
+_CRF_DOUBLING = 6.0
+_MIN_CRF, _MAX_CRF = 18, 38
+# Re-sample at the chosen CRF when the extrapolation reaches this far
+_CRF_RESAMPLE_DISTANCE = 3
+# Below this the whole file is short enough that sampling costs more than it saves
+_MIN_SAMPLED_DURATION = 60.0
+_AUDIO_ENCODE_SPEED = 40.0  # x realtime, for the audio-only time estimate
+
+# Resolution ladder (short side), tried tallest first: the first rung that still
+# gives every pixel _MIN_BITS_PER_PIXEL bits per frame is used
+_LADDER = (1080, 720, 480, 360, 240)
+_MIN_BITS_PER_PIXEL = 0.05
+# High frame rates are halved to this before any downscale is considered
+_LOW_FPS = 30.0
+
+# Segmented encoding: below this duration one ffmpeg process is fast enough
+_SEGMENT_MIN_DURATION = 180.0
+_MIN_SEGMENT_SECONDS = 20.0
+# More segments than workers keeps every core busy until the end
+_SEGMENTS_PER_WORKER = 2
+
+# Shared by all jobs, so concurrent compressions never run more than ENCODE_WORKERS segments
+_segment_slots = asyncio.Semaphore(max(1, ENCODE_WORKERS))
+
+
+def output_stem(file_path: str, workdir: str | None = None) -> str:
+    """*file_path* without its extension, moved into *workdir* if given; derived files are named after it."""
+    base = os.path.splitext(file_path)[0]
+    return os.path.join(workdir, os.path.basename(base)) if workdir else base
+
+
+async def probe_media(file_path: str) -> dict:
+    """Return duration, width, height and fps of a media file via ffprobe.
+
+    Missing values are None; duration falls back to 300 s like _get_duration.
+    """
+    cmd = [
+        _FFPROBE_PATH,
+        "-v", "error",
+        "-show_entries", "format=duration:stream=codec_type,width,height,avg_frame_rate",
+        "-of", "json",
+        file_path,
+    ]
+    loop = asyncio.get_event_loop()
+    media = {"duration": 300.0, "width": None, "height": None, "fps": None}
+    try:
+        result = await loop.run_in_executor(
+            scheduler.executor("probe"),
+            partial(subprocess.run, cmd, capture_output=True, text=True, timeout=30),
+        )
+        data = json.loads(result.stdout)
+    except Exception:
+        logger.warning("Could not probe %s, using 300 s fallback", file_path)
+        return media
+
+    try:
+        media["duration"] = float(data["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        logger.warning("No duration for %s, using 300 s fallback", file_path)
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") != "video" or not stream.get("width"):
+            continue
+        media["width"] = stream["width"]
+        media["height"] = stream["height"]
+        num, _, den = (stream.get("avg_frame_rate") or "0/0").partition("/")
+        if den and float(den) > 0 and float(num) > 0:
+            media["fps"] = float(num) / float(den)
+        break
+    return media
+
+
+def container_overhead(duration: float, fps: float | None) -> int:
+    """Estimated bytes the MP4 container adds on top of the elementary streams."""
+    packets_per_sec = (fps or 30.0) + _AAC_PACKETS_PER_SEC
+    return int(_CONTAINER_FIXED_BYTES + duration * packets_per_sec * _BYTES_PER_PACKET)
+
+
+def target_bitrates(
+    duration: float, target_bytes: int, fps: float | None = None, audio_kbps: int = _DEFAULT_AUDIO_KBPS,
+) -> tuple[int, int]:
+    """Return (video_kbps, audio_kbps) whose encode lands just under *target_bytes*."""
+    duration = max(duration, 1.0)
+    budget = target_bytes * (1 - _SIZE_MARGIN) - container_overhead(duration, fps)
+    total_kbps = budget * 8 / duration / 1000
+    # Very long videos: give video at least as much as audio before starving it
+    audio_kbps = max(_MIN_AUDIO_KBPS, min(audio_kbps, int(total_kbps / 2)))
+    video_kbps = max(_MIN_VIDEO_KBPS, int(total_kbps - audio_kbps))
+    return video_kbps, audio_kbps
+
+
+def plan_resolution(
+    width: int | None, height: int | None, fps: float | None, video_kbps: int,
+) -> tuple[int | None, float | None]:
+    """Pick the output (short side, fps) for *video_kbps* from a bits-per-pixel floor.
+
+    None means "keep the source value". Frame rates above 30 are dropped to 30
+    first, since a lower frame rate costs less than fewer pixels; then the
+    resolution steps down the ladder until the bits per pixel are acceptable.
+    """
+    if not width or not height:
+        return None, None
+    fps = fps or _LOW_FPS
+    short, long_ = min(width, height), max(width, height)
+
+    def bpp(rung: int, rate: float) -> float:
+        return video_kbps * 1000 / (rung * rung * long_ / short * rate)
+
+    out_fps = fps
+    if fps > _LOW_FPS and bpp(short, fps) < _MIN_BITS_PER_PIXEL:
+        out_fps = _LOW_FPS
+    rungs = [short] + [r for r in _LADDER if r < short]
+    out_short = rungs[-1]
+    for rung in rungs:
+        if bpp(rung, out_fps) >= _MIN_BITS_PER_PIXEL:
+            out_short = rung
+            break
+    return (
+        out_short if out_short != short else None,
+        out_fps if out_fps != fps else None,
+    )
+
+
+def scale_args(width: int | None, height: int | None, short_side: int | None, fps: float | None) -> list[str]:
+    """ffmpeg options applying a plan_resolution() result (empty when nothing changes)."""
+    args = []
+    if short_side and width and height:
+        size = f"-2:{short_side}" if width >= height else f"{short_side}:-2"
+        args += ["-vf", f"scale={size}"]
+    if fps:
+        args += ["-r", f"{fps:g}"]
+    return args
+
+
+def _rate_control(video_kbps: int) -> list[str]:
+    return [
+        "-c:v", "libx264",
+        "-preset", "medium",
+        "-b:v", f"{video_kbps}k",
+        "-maxrate", f"{int(video_kbps * _MAXRATE_FACTOR)}k",
+        "-bufsize", f"{int(video_kbps * _BUFSIZE_FACTOR)}k",
+    ]
+
+
+async def two_pass_encode(
+    file_path: str, out_path: str, duration: float, video_kbps: int, audio_kbps: int,
+    scale: list[str] = (), progress_callback=None,
+) -> None:
+    """Two-pass ABR x264 encode of *file_path* into *out_path* (MP4, AAC audio).
+
+    *scale* is a scale_args() result applied to the video. *progress_callback(text)*
+    gets percent, speed and ETA of each pass.
+    """
+    if use_segments(duration):
+        await segmented_encode(
+            file_path, out_path, duration, [*scale, *_rate_control(video_kbps)], audio_kbps, two_pass=True,
+            progress_callback=progress_callback,
+        )
+        return
+    passlog = f"{out_path}.passlog"
+    timeout = max(600.0, duration * 2)
+    first = [
+        FFMPEG_PATH, "-y", "-i", file_path,
+        *scale, *_rate_control(video_kbps),
+        "-pass", "1", "-passlogfile", passlog,
+        "-an", "-f", "null", os.devnull,
+    ]
+    second = [
+        FFMPEG_PATH, "-y", "-i", file_path,
+        *scale, *_rate_control(video_kbps),
+        "-pass", "2", "-passlogfile", passlog,
+        "-c:a", "aac", "-b:a", f"{audio_kbps}k",
+        "-movflags", "+faststart",
+        out_path,
+    ]
+    try:
+        await run_ffmpeg(
+            first, timeout, duration, text_reporter(progress_callback, "Сжимаю, проход 1/2"), is_audio=False,
+        )
+        await run_ffmpeg(
+            second, timeout, duration, text_reporter(progress_callback, "Сжимаю, проход 2/2"), is_audio=False,
+        )
+    finally:
+        for suffix in ("-0.log", "-0.log.mbtree", "-0.log.temp", "-0.log.mbtree.temp"):
+            if os.path.exists(passlog + suffix):
+                os.remove(passlog + suffix)
+
+
+def use_segments(duration: float) -> bool:
+    """Whether a video of *duration* seconds is worth splitting for a parallel encode."""
+    return ENCODE_WORKERS > 1 and duration >= _SEGMENT_MIN_DURATION
+
+
+class _SegmentProgress:
+    """Folds the -progress streams of parallel segment encodes into one progress line."""
+
+    def __init__(self, callback, duration: float, passes: int) -> None:
+        self._callback = callback
+        self._total = duration * passes
+        self._passes = passes
+        self._done: dict[tuple[str, int], float] = {}
+        self._started = time.monotonic()
+
+    def reporter(self, segment: str, pass_no: int):
+        if self._callback is None:
+            return None
+
+        def on_progress(progress) -> None:
+            self._done[(segment, pass_no)] = progress.out_seconds
+            self._report()
+
+        return on_progress
+
+    def _report(self) -> None:
+        done = sum(self._done.values())
+        elapsed = time.monotonic() - self._started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        self._callback(progress_text(
+            "Сжимаю по частям",
+            min(1.0, done / self._total),
+            rate / self._passes or None,
+            (self._total - done) / rate if rate else None,
+        ))
+
+
+async def _encode_segment(
+    src: str, dst: str, duration: float, video_args: list[str], two_pass: bool, progress: _SegmentProgress,
+) -> None:
+    threads = ["-threads", str(max(1, (os.cpu_count() or 1) // ENCODE_WORKERS))]
+    timeout = max(600.0, duration * 4)
+    name = os.path.basename(src)
+    async with _segment_slots:
+        if two_pass:
+            passlog = f"{dst}.passlog"
+            await run_ffmpeg(
+                [FFMPEG_PATH, "-y", "-i", src, *video_args, *threads,
+                 "-pass", "1", "-passlogfile", passlog, "-an", "-f", "null", os.devnull],
+                timeout, on_progress=progress.reporter(name, 1),
+            )
+            await run_ffmpeg(
+                [FFMPEG_PATH, "-y", "-i", src, *video_args, *threads,
+                 "-pass", "2", "-passlogfile", passlog, "-an", dst],
+                timeout, on_progress=progress.reporter(name, 2),
+            )
+        else:
+            await run_ffmpeg(
+                [FFMPEG_PATH, "-y", "-i", src, *video_args, *threads, "-an", dst],
+                timeout, on_progress=progress.reporter(name, 1),
+            )
+
+
+async def segmented_encode(
+    file_path: str, out_path: str, duration: float, video_args: list[str], audio_kbps: int,
+    two_pass: bool = False, progress_callback=None,
+) -> None:
+    """Encode the video in keyframe-aligned segments on all cores, then join them losslessly.
+
+    Every segment gets the same *video_args*, so with a fixed bitrate each one
+    takes its duration's share of the target. Audio is encoded once for the
+    whole file and muxed in with the concatenated video (stream copy).
+    *progress_callback(text)* gets the combined progress of all segments.
+    """
+    workdir = f"{out_path}.segments"
+    os.makedirs(workdir, exist_ok=True)
+    segment_time = max(duration / (ENCODE_WORKERS * _SEGMENTS_PER_WORKER), _MIN_SEGMENT_SECONDS)
+    timeout = max(600.0, duration)
+    passes = 2 if two_pass else 1
+    progress = _SegmentProgress(progress_callback, duration, passes)
+    started = time.monotonic()
+    try:
+        # Stream copy can only cut at keyframes; the segment muxer picks the next one
+        await run_ffmpeg([
+            FFMPEG_PATH, "-y", "-i", file_path, "-map", "0:v:0", "-c", "copy",
+            "-f", "segment", "-segment_time", f"{segment_time:.1f}", "-reset_timestamps", "1",
+            os.path.join(workdir, "src_%04d.mkv"),
+        ], timeout)
+        sources = sorted(f for f in os.listdir(workdir) if f.startswith("src_"))
+        logger.info("segmented_encode: %s -> %d segments of ~%.0f s", file_path, len(sources), segment_time)
+
+        audio_path = os.path.join(workdir, "audio.m4a")
+        jobs = [
+            _encode_segment(
+                os.path.join(workdir, name),
+                os.path.join(workdir, name.replace("src_", "enc_").replace(".mkv", ".mp4")),
+                segment_time, video_args, two_pass, progress,
+            )
+            for name in sources
+        ]
+        jobs.append(_encode_audio_track(file_path, audio_path, audio_kbps, timeout))
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        for result in results[:-1]:
+            if isinstance(result, BaseException):
+                raise result
+        has_audio = not isinstance(results[-1], BaseException) and os.path.exists(audio_path)
+        if not has_audio:
+            logger.info("segmented_encode: no audio track in %s (%s)", file_path, results[-1])
+
+        concat_list = os.path.join(workdir, "concat.txt")
+        with open(concat_list, "w") as f:
+            for name in sources:
+                f.write(f"file '{name.replace('src_', 'enc_').replace('.mkv', '.mp4')}'\n")
+        cmd = [FFMPEG_PATH, "-y", "-f", "concat", "-safe", "0", "-i", concat_list]
+        if has_audio:
+            cmd += ["-i", audio_path, "-map", "0:v", "-map", "1:a"]
+        cmd += ["-c", "copy", "-movflags", "+faststart", out_path]
+        await run_ffmpeg(cmd, timeout)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    # The whole job's throughput, which is what the scheduler has to plan with
+    observe_encode(False, duration * passes / (time.monotonic() - started))
+
+
+async def _encode_audio_track(file_path: str, audio_path: str, audio_kbps: int, timeout: float) -> None:
+    async with _segment_slots:
+        await run_ffmpeg([
+            FFMPEG_PATH, "-y", "-i", file_path, "-map", "0:a:0?", "-vn",
+            "-c:a", "aac", "-b:a", f"{audio_kbps}k", audio_path,
+        ], timeout)
+
+
+async def _encode_samples(
+    file_path: str, duration: float, crf: int, scale: list[str] = (), workdir: str | None = None,
+) -> tuple[float, float]:
+    """Encode the sample slices at *crf*; return (video bytes per second, encode seconds per second)."""
+    base = output_stem(file_path, workdir)
+    length = min(_SAMPLE_SECONDS, duration / _SAMPLE_COUNT)
+    total_bytes = 0
+    started = time.monotonic()
+    for i in range(_SAMPLE_COUNT):
+        start = duration * (i + 1) / (_SAMPLE_COUNT + 1) - length / 2
+        sample_path = f"{base}_sample{i}.mp4"
+        cmd = [
+            FFMPEG_PATH, "-y", "-ss", f"{max(start, 0):.2f}", "-i", file_path, "-t", f"{length:.2f}",
+            *scale, "-c:v", "libx264", "-preset", "medium", "-crf", str(crf),
+            "-an", sample_path,
+        ]
+        try:
+            await run_ffmpeg(cmd, 120)
+            total_bytes += os.path.getsize(sample_path)
+        finally:
+            if os.path.exists(sample_path):
+                os.remove(sample_path)
+    sampled = length * _SAMPLE_COUNT
+    return total_bytes / sampled, (time.monotonic() - started) / sampled
+
+
+async def plan_compression(
+    file_path: str, target_bytes: int, media: dict | None = None, workdir: str | None = None,
+) -> dict:
+    """Predict how to hit *target_bytes* before running any full-length encode.
+
+    Video files are sampled at a probe CRF and the size is extrapolated per CRF
+    step; if some CRF in range fits, the plan is a capped single-pass CRF encode,
+    otherwise two-pass ABR. The plan carries ``predicted_bytes`` and
+    ``predicted_seconds`` (encode time) for display. Sample files go to *workdir*
+    if given, else next to the source.
+    """
+    if media is None:
+        media = await probe_media(file_path)
+    duration = max(media["duration"], 1.0)
+    ext = os.path.splitext(file_path)[1].lower()
+    is_audio = ext in AUDIO_EXTS or media["width"] is None
+
+    if is_audio:
+        total_kbps = int(target_bytes * (1 - _SIZE_MARGIN) * 8 / duration / 1000)
+        audio_kbps = max(64, min(total_kbps, 192))
+        return {
+            "mode": "audio",
+            "video_kbps": 0,
+            "audio_kbps": audio_kbps,
+            "predicted_bytes": int(audio_kbps * 1000 / 8 * duration),
+            "predicted_seconds": duration / _AUDIO_ENCODE_SPEED,
+            "media": media,
+        }
+
+    video_kbps, audio_kbps = target_bitrates(duration, target_bytes, media["fps"])
+    out_short, out_fps = plan_resolution(media["width"], media["height"], media["fps"], video_kbps)
+    scale = scale_args(media["width"], media["height"], out_short, out_fps)
+    if out_fps:
+        video_kbps, audio_kbps = target_bitrates(duration, target_bytes, out_fps)
+    plan = {
+        "mode": "abr",
+        "video_kbps": video_kbps,
+        "audio_kbps": audio_kbps,
+        "scale": scale,
+        "short_side": out_short or min(media["width"], media["height"]),
+        "predicted_bytes": int(target_bytes * (1 - _SIZE_MARGIN)),
+        "predicted_seconds": None,
+        "media": media,
+    }
+    if duration < _MIN_SAMPLED_DURATION:
+        return plan
+
+    video_budget = video_kbps * 1000 / 8 * duration
+    try:
+        rate, speed = await _encode_samples(file_path, duration, _PROBE_CRF, scale, workdir)
+        crf = _PROBE_CRF + _CRF_DOUBLING * math.log2(rate * duration / video_budget)
+        crf = math.ceil(min(max(crf, _MIN_CRF), _MAX_CRF))
+        if abs(crf - _PROBE_CRF) >= _CRF_RESAMPLE_DISTANCE:
+            rate, speed = await _encode_samples(file_path, duration, crf, scale, workdir)
+        else:
+            rate *= 2 ** ((_PROBE_CRF - crf) / _CRF_DOUBLING)
+    except Exception as e:
+        logger.warning("Sample encode failed for %s, planning two-pass: %s", file_path, e)
+        return plan
+
+    # Two-pass costs about two encodes at the sampled speed
+    plan["predicted_seconds"] = speed * duration * 2
+    predicted_video = rate * duration
+    if predicted_video <= video_budget:
+        plan.update(
+            mode="crf",
+            crf=crf,
+            predicted_bytes=int(
+                predicted_video + audio_kbps * 1000 / 8 * duration + container_overhead(duration, out_fps or media["fps"])
+            ),
+            predicted_seconds=speed * duration,
+        )
+    logger.info(
+        "Compression plan for %s: %s %sp, ~%.1f MB, ~%.0f s",
+        file_path, plan["mode"], plan["short_side"],
+        plan["predicted_bytes"] / 1024 / 1024, plan["predicted_seconds"],
+    )
+    return plan
+
+
+async def crf_encode(
+    file_path: str, out_path: str, duration: float, crf: int, video_kbps: int, audio_kbps: int,
+    scale: list[str] = (), progress_callback=None,
+) -> None:
+    """Single-pass CRF x264 encode, VBV-capped at *video_kbps* so the size stays bounded."""
+    video_args = [
+        *scale,
+        "-c:v", "libx264", "-preset", "medium", "-crf", str(crf),
+        "-maxrate", f"{video_kbps}k", "-bufsize", f"{int(video_kbps * _BUFSIZE_FACTOR)}k",
+    ]
+    if use_segments(duration):
+        await segmented_encode(
+            file_path, out_path, duration, video_args, audio_kbps, progress_callback=progress_callback,
+        )
+        return
+    cmd = [
+        FFMPEG_PATH, "-y", "-i", file_path,
+        *video_args,
+        "-c:a", "aac", "-b:a", f"{audio_kbps}k",
+        "-movflags", "+faststart",
+        out_path,
+    ]
+    await run_ffmpeg(
+        cmd, max(600.0, duration * 2), duration, text_reporter(progress_callback, "Сжимаю"), is_audio=False,
+    )
+
+
+async def compress_to_target(
+    file_path: str, target_bytes: int, plan: dict | None = None, progress_callback=None,
+    workdir: str | None = None,
+) -> tuple[str, int, int, int]:
+    """Compress to fit *target_bytes* in one run.
+
+    Follows a plan_compression() plan (computed here if not given): a capped CRF
+    encode when the sample encodes predict it fits, otherwise a two-pass ABR
+    encode sized from the duration minus the container overhead. Audio-only
+    files get a CBR re-encode, which is exact. *progress_callback(text)* gets
+    percent, speed and ETA while ffmpeg runs. The output goes to *workdir* if
+    given, else next to the source.
+    Returns (compressed_path, size_bytes, video_kbps, audio_kbps).
+    """
+    base, ext = output_stem(file_path, workdir), os.path.splitext(file_path)[1]
+    if plan is None:
+        plan = await plan_compression(file_path, target_bytes, workdir=workdir)
+    duration = plan["media"]["duration"]
+    video_kbps, audio_kbps = plan["video_kbps"], plan["audio_kbps"]
+
+    if plan["mode"] == "audio":
+        compressed_path = f"{base}_compressed{ext}"
+    else:
+        compressed_path = f"{base}_compressed.mp4"
+
+    logger.info(
+        "compress_to_target: %s (%.1f MB, %.0f s) -> %s video=%dk audio=%dk",
+        file_path, os.path.getsize(file_path) / 1024 / 1024, duration, plan["mode"], video_kbps, audio_kbps,
+    )
+
+    try:
+        if plan["mode"] == "audio":
+            cmd = [FFMPEG_PATH, "-y", "-i", file_path, "-b:a", f"{audio_kbps}k", compressed_path]
+            await run_ffmpeg(
+                cmd, max(600.0, duration), duration, text_reporter(progress_callback, "Сжимаю"), is_audio=True,
+            )
+        elif plan["mode"] == "crf":
+            await crf_encode(
+                file_path, compressed_path, duration, plan["crf"], video_kbps, audio_kbps, plan["scale"],
+                progress_callback,
+            )
+        else:
+            await two_pass_encode(
+                file_path, compressed_path, duration, video_kbps, audio_kbps, plan["scale"],
+                progress_callback,
+            )
+    except Exception as e:
+        logger.error("compress_to_target ffmpeg error: %s", e)
+        if os.path.exists(compressed_path):
+            os.remove(compressed_path)
+        raise RuntimeError(f"ffmpeg failed: {e}") from e
+
+    if not os.path.exists(compressed_path) or os.path.getsize(compressed_path) == 0:
+        raise RuntimeError("ffmpeg produced no output file")
+
+    return compressed_path, os.path.getsize(compressed_path), video_kbps, audio_kbps
@@ -8,9 +8,16 @@ BOT_TOKEN: str = os.getenv("BOT_TOKEN", "")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN is not set in environment / .env file")
 
+# Large files go to Yandex.Disk: a local synced folder, or WebDAV if WEBDAV_URL is set
 YANDEX_DISK_PATH: str = os.getenv("YANDEX_DISK_PATH", "")
-if not YANDEX_DISK_PATH:
-    raise ValueError("YANDEX_DISK_PATH is not set in environment / .env file")
+WEBDAV_URL: str = os.getenv("WEBDAV_URL", "").rstrip("/")
+WEBDAV_USER: str = os.getenv("WEBDAV_USER", "")
+WEBDAV_PASSWORD: str = os.getenv("WEBDAV_PASSWORD", "")
+WEBDAV_ROOT: str = os.getenv("WEBDAV_ROOT", "/YouTube Downloads")
+WEBDAV_PARALLEL: int = int(os.getenv("WEBDAV_PARALLEL", "2"))
+WEBDAV_CHUNK_SIZE: int = int(os.getenv("WEBDAV_CHUNK_SIZE", "67108864"))
+if not YANDEX_DISK_PATH and not WEBDAV_URL:
+    raise ValueError("Neither YANDEX_DISK_PATH nor WEBDAV_URL is set in environment / .env file")
 
 _allowed_raw = os.getenv("ALLOWED_USERS", "")
 ALLOWED_USERS: list[int] = (
@@ -27,3 +34,55 @@ MAX_TELEGRAM_SIZE: int = int(os.getenv("MAX_TELEGRAM_SIZE", "52428800"))
 FFMPEG_PATH: str = os.getenv("FFMPEG_PATH", "/usr/local/bin/ffmpeg")
 
 LOCAL_API_URL: str = os.getenv("LOCAL_API_URL", "")
+
+# Webhook mode: Telegram pushes updates to WEBHOOK_URL/WEBHOOK_PATH instead of being polled
+WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_LISTEN: str = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+# Telegram sends it in every request; others are rejected (A-Z, a-z, 0-9, _ and -)
+WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+
+# Handlers running at once; each user's updates still run one at a time, in order
+CONCURRENT_UPDATES: int = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# Connections reserved for sending files to Telegram, and how long one send may stall
+UPLOAD_CONNECTIONS: int = int(os.getenv("UPLOAD_CONNECTIONS", "4"))
+UPLOAD_TIMEOUT: float = float(os.getenv("UPLOAD_TIMEOUT", "300"))
+
+# Metadata cache for get_video_info: in-memory LRU plus optional sqlite file
+INFO_CACHE_SIZE: int = int(os.getenv("INFO_CACHE_SIZE", "128"))
+INFO_CACHE_TTL: int = int(os.getenv("INFO_CACHE_TTL", "21600"))
+INFO_CACHE_DB: str = os.getenv("INFO_CACHE_DB", "")
+
+# Finished downloads kept for reuse (bytes); 0 keeps nothing beyond in-flight sharing
+DOWNLOAD_CACHE_SIZE: int = int(os.getenv("DOWNLOAD_CACHE_SIZE", "2147483648"))
+
+# Telegram file_id index: lets repeat requests be re-sent without any download/upload
+FILE_ID_DB: str = os.getenv("FILE_ID_DB", os.path.join(DOWNLOAD_DIR, "file_ids.sqlite3"))
+
+# Users' conversation state (the last link and its buttons) is saved here and survives restarts
+STATE_FILE: str = os.getenv("STATE_FILE", os.path.join(DOWNLOAD_DIR, "state.pickle"))
+
+# Job queue the bot fills and workers (python -m bot.worker) empty; all of them must share it and FILE_ID_DB
+JOB_QUEUE_DB: str = os.getenv("JOB_QUEUE_DB", os.path.join(DOWNLOAD_DIR, "jobs.sqlite3"))
+# Separate workers need both set explicitly: the defaults in DOWNLOAD_DIR would give each its own
+QUEUE_FILES_SET: bool = bool(os.getenv("JOB_QUEUE_DB") and os.getenv("FILE_ID_DB"))
+# Jobs the bot process runs itself (0 = only separate workers run them) and jobs per worker process
+BOT_WORKER_JOBS: int = int(os.getenv("BOT_WORKER_JOBS", "4"))
+WORKER_JOBS: int = int(os.getenv("WORKER_JOBS", "4"))
+
+# Job scheduler: concurrent downloads, ffmpeg encodes and metadata probes
+DOWNLOAD_SLOTS: int = int(os.getenv("DOWNLOAD_SLOTS", "3"))
+FFMPEG_SLOTS: int = int(os.getenv("FFMPEG_SLOTS", str(max(1, (os.cpu_count() or 2) // 2))))
+PROBE_SLOTS: int = int(os.getenv("PROBE_SLOTS", "4"))
+JOBS_PER_USER: int = int(os.getenv("JOBS_PER_USER", "1"))
+# Seconds of estimated cost forgiven per second a job waits (prevents starvation)
+SCHEDULER_AGING: float = float(os.getenv("SCHEDULER_AGING", "1.0"))
+
+# yt-dlp worker processes (0 = run yt-dlp in threads of the bot process)
+YTDLP_WORKERS: int = int(os.getenv("YTDLP_WORKERS", "0"))
+YTDLP_HANG_TIMEOUT: float = float(os.getenv("YTDLP_HANG_TIMEOUT", "600"))
+
+# Long videos are split at keyframes and this many segments are encoded at once
+ENCODE_WORKERS: int = int(os.getenv("ENCODE_WORKERS", str(os.cpu_count() or 1)))
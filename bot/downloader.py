@@ -2,18 +2,33 @@ import asyncio
 import logging
 import os
 import subprocess
+import threading
 import time
 from functools import partial
 
-import yt_dlp
-
-from bot.config import DOWNLOAD_DIR, FFMPEG_PATH, MAX_TELEGRAM_SIZE
+from bot.compressor import output_stem, segmented_encode, use_segments
+from bot.config import FFMPEG_PATH, MAX_TELEGRAM_SIZE, YTDLP_HANG_TIMEOUT, YTDLP_WORKERS
+from bot.ffmpeg import run_ffmpeg, text_reporter
+from bot.file_cache import download_cache
+from bot.info_cache import info_cache
+from bot.scheduler import download_cost, encode_cost, scheduler
+from bot.urls import canonical_url, extract_video_id
+from bot.ytdl_workers import (
+    YtdlProcessPool,
+    pick_stream_format,
+    run_download,
+    run_extract,
+    run_stream,
+    ydl_pool,
+)
 
 logger = logging.getLogger(__name__)
 
 COMMON_RESOLUTIONS = {"360p", "480p", "720p", "1080p"}
 
 _UPDATE_INTERVAL = 4.0  # seconds between progress updates to Telegram
+# After a cancel, how long to wait for a yt-dlp thread to let go of its files
+_ABORT_GRACE = 5.0
 
 
 def _make_hooks(progress_callback):
@@ -72,21 +87,8 @@ def _make_hooks(progress_callback):
 _FFPROBE_PATH = FFMPEG_PATH.replace("ffmpeg", "ffprobe") if "ffmpeg" in FFMPEG_PATH else "ffprobe"
 
 
-async def get_video_info(url: str) -> dict:
-    """Fetch video metadata and available resolutions (no download)."""
-    opts = {
-        "quiet": True,
-        "no_warnings": True,
-        "extract_flat": False,
-    }
-
-    loop = asyncio.get_event_loop()
-
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        info = await loop.run_in_executor(
-            None, partial(ydl.extract_info, url, download=False)
-        )
-
+def _summarize(info: dict) -> dict:
+    """Reduce a raw yt-dlp info dict to what the resolution keyboard needs."""
     seen_resolutions: set[str] = set()
     formats: list[dict] = []
     for f in info.get("formats", []):
@@ -104,6 +106,7 @@ async def get_video_info(url: str) -> dict:
                 "resolution": resolution,
                 "height": height,
                 "filesize_approx": f.get("filesize") or f.get("filesize_approx"),
+                "estimated_size": estimate_size(info, height),
             }
         )
 
@@ -118,38 +121,373 @@ async def get_video_info(url: str) -> dict:
     }
 
 
-async def download_video(url: str, height: int, progress_callback=None) -> tuple[str, str]:
-    """Download video at the given resolution. Returns (file_path, title)."""
+_EXTRACT_OPTS = {
+    "quiet": True,
+    "no_warnings": True,
+    "extract_flat": False,
+}
+
+# Worker processes for yt-dlp (YTDLP_WORKERS > 0); otherwise jobs run in scheduler threads
+_process_pool = (
+    YtdlProcessPool(YTDLP_WORKERS, YTDLP_HANG_TIMEOUT, warm_opts=_EXTRACT_OPTS)
+    if YTDLP_WORKERS > 0
+    else None
+)
+
+
+def _warm_in_thread() -> None:
+    started = time.perf_counter()
+    try:
+        ydl_pool.warm(_EXTRACT_OPTS)
+    except Exception:
+        logger.warning("yt-dlp pre-warm failed", exc_info=True)
+        return
+    logger.info("yt-dlp pre-warmed in %.0f ms", (time.perf_counter() - started) * 1000)
+
+
+def start_workers() -> None:
+    """Pre-warm yt-dlp without delaying startup: worker processes or a background import."""
+    if _process_pool is not None:
+        _process_pool.warm_up()
+        logger.info("Started %d yt-dlp worker processes", YTDLP_WORKERS)
+    else:
+        threading.Thread(target=_warm_in_thread, name="ytdl-warm", daemon=True).start()
+
+
+def stop_workers() -> None:
+    if _process_pool is not None:
+        _process_pool.shutdown()
+
+
+async def _run_ytdl(pool: str, kind: str, args: tuple, progress_hook=None, pp_hook=None) -> dict:
+    """Run a yt-dlp job ("extract" or "download") on the scheduler pool's executor."""
+    executor = scheduler.executor(pool)
+    if _process_pool is not None:
+        return await _process_pool.run(executor, kind, args, progress_hook, pp_hook)
+
+    if kind == "extract":
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, partial(run_extract, *args))
+
+    # A thread cannot be killed: yt-dlp is stopped by a hook raising at its next call
+    abort = threading.Event()
+    runner = partial(
+        run_download, *args,
+        progress_hook=_abortable(progress_hook, abort), pp_hook=_abortable(pp_hook, abort),
+    )
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(executor, runner)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        abort.set()
+        await asyncio.wait([future], timeout=_ABORT_GRACE)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        raise
+
+
+def _abortable(hook, abort: threading.Event):
+    """Wrap a yt-dlp hook so it raises DownloadCancelled once *abort* is set."""
+    from yt_dlp.utils import DownloadCancelled
+
+    def wrapper(d):
+        if abort.is_set():
+            raise DownloadCancelled()
+        if hook:
+            hook(d)
+
+    return wrapper
+
+
+async def _extract(url: str) -> dict:
+    """Run the yt-dlp extractor for *url* without downloading."""
+    return await _run_ytdl("probe", "extract", (_EXTRACT_OPTS, url))
+
+
+# video_id -> extraction task, so concurrent callers share one extractor round trip
+_inflight: dict[str, asyncio.Task] = {}
+# Running prefetch_info() tasks; nothing else holds on to them
+_prefetches: set[asyncio.Task] = set()
+
+
+async def _extract_and_cache(video_id: str) -> dict:
+    info = await _extract(canonical_url(video_id))
+    info_cache.put(video_id, _summarize(info), info)
+    return info
+
+
+async def resolve_info(url: str) -> dict:
+    """Return the raw yt-dlp info dict for *url*, reusing cached or in-flight extractions."""
+    video_id = extract_video_id(url)
+    if video_id is None:
+        return await _extract(url)
+
+    info = info_cache.get_info(video_id)
+    if info is not None:
+        return info
+
+    task = _inflight.get(video_id)
+    if task is None:
+        task = asyncio.ensure_future(_extract_and_cache(video_id))
+        _inflight[video_id] = task
+        task.add_done_callback(lambda _: _inflight.pop(video_id, None))
+    # Shielded: one waiter giving up must not cancel the extraction for the others
+    return await asyncio.shield(task)
+
+
+def cached_info(url: str) -> dict | None:
+    """The raw yt-dlp info dict for *url* if it is cached; never waits for an extraction."""
+    video_id = extract_video_id(url)
+    return info_cache.get_info(video_id) if video_id else None
+
+
+def _log_prefetch_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.info("Prefetch failed, will retry on demand: %s", task.exception())
+
+
+def prefetch_info(url: str) -> asyncio.Task:
+    """Start resolving *url* in the background while the user picks a format."""
+    task = asyncio.ensure_future(resolve_info(url))
+    # The event loop keeps only weak references to tasks
+    _prefetches.add(task)
+    task.add_done_callback(_prefetches.discard)
+    task.add_done_callback(_log_prefetch_error)
+    return task
+
+
+async def get_video_info(url: str) -> dict:
+    """Fetch video metadata and available resolutions (no download).
+
+    Results are cached by video ID, so repeated links skip the extractor.
+    """
+    video_id = extract_video_id(url)
+    if video_id:
+        cached = info_cache.get_summary(video_id)
+        if cached is not None:
+            logger.info("Info cache hit for %s", video_id)
+            return cached
+
+    return _summarize(await resolve_info(url))
+
+
+def _format_size(f: dict, duration: float) -> float:
+    """Size of one yt-dlp format: exact, approximate, or bitrate × duration."""
+    size = f.get("filesize") or f.get("filesize_approx")
+    if not size and f.get("tbr") and duration:
+        size = f["tbr"] * 1000 / 8 * duration
+    return size or 0
+
+
+def _last(formats: list[dict], match) -> dict | None:
+    """The best format matching *match*: yt-dlp sorts resolved formats worst to best."""
+    return next((f for f in reversed(formats) if match(f)), None)
+
+
+def _has_video(f: dict) -> bool:
+    return f.get("vcodec") not in (None, "none")
+
+
+def _has_audio(f: dict) -> bool:
+    return f.get("acodec") not in (None, "none")
+
+
+def estimate_size(info: dict, height: int | None = None) -> int | None:
+    """Rough size of what download_video() fetches for *height*, or of the best audio if None.
+
+    Follows its format spec, ``bestvideo[height<=N]+bestaudio/best[height<=N]``:
+    the best video-only and audio-only formats, else the best progressive one.
+    """
+    duration = info.get("duration") or 0
+    formats = info.get("formats") or []
+
+    best_audio = _last(formats, lambda f: not _has_video(f) and _has_audio(f))
+    if height is None:
+        return int(_format_size(best_audio, duration)) if best_audio else None
+
+    def fits_height(f: dict) -> bool:
+        return bool(f.get("height")) and f["height"] <= height
+
+    video = _last(formats, lambda f: fits_height(f) and _has_video(f) and not _has_audio(f))
+    if video is not None and best_audio is not None:
+        return int(_format_size(video, duration) + _format_size(best_audio, duration)) or None
+    progressive = _last(formats, lambda f: fits_height(f) and _has_video(f) and _has_audio(f))
+    if progressive is None:
+        return None
+    return int(_format_size(progressive, duration)) or None
+
+
+# Estimates are rough (approximate sizes, tbr × duration, merge overhead)
+_FIT_MARGIN = 0.05
+
+
+def fits(size: int | None, limit: int) -> bool:
+    """Whether an estimated size safely stays under *limit*; the one test for ✅ and fit_format()."""
+    return bool(size) and size <= limit * (1 - _FIT_MARGIN)
+
+
+def fit_format(info: dict, limit: int) -> tuple[str, int, int] | None:
+    """Best format combination whose estimated merged size stays under *limit*.
+
+    Considers every video format with a known size, paired with every audio
+    format (or alone if progressive), and prefers height, then video bitrate,
+    then audio bitrate. Returns (yt-dlp format spec, height, estimated bytes),
+    or None if nothing with a known size fits.
+    """
+    duration = info.get("duration") or 0
+    formats = info.get("formats") or []
+
+    audio = [
+        (f, _format_size(f, duration)) for f in formats
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")
+    ]
+    audio = [(f, size) for f, size in audio if size]
+
+    best = None
+    for v in formats:
+        if not v.get("height") or v.get("vcodec") in (None, "none"):
+            continue
+        video_size = _format_size(v, duration)
+        if not video_size:
+            continue
+        if v.get("acodec") not in (None, "none"):
+            pairs = [(v["format_id"], video_size, 0)]
+        else:
+            pairs = [
+                (f"{v['format_id']}+{a['format_id']}", video_size + size, a.get("abr") or a.get("tbr") or 0)
+                for a, size in audio
+            ]
+        for spec, size, abr in pairs:
+            rank = (v["height"], v.get("tbr") or 0, abr)
+            if fits(size, limit) and (best is None or rank > best[0]):
+                best = (rank, spec, v["height"], int(size))
+    if best is None:
+        return None
+    return best[1], best[2], best[3]
+
+
+def video_cost(info: dict, height: int) -> float:
+    """Estimated seconds download_video() at *height* keeps a download slot."""
+    return download_cost(estimate_size(info, height), info.get("duration"))
+
+
+def audio_cost(info: dict, bitrate: str) -> float:
+    """Estimated seconds download_audio() at *bitrate* keeps its slot."""
+    cost = download_cost(estimate_size(info), info.get("duration"))
+    # MP3 bitrates are transcoded while downloading, so only M4A adds an encode
+    if bitrate == "m4a":
+        cost += encode_cost(info.get("duration"), is_audio=True)
+    return cost
+
+
+def _cache_settings(opts: dict) -> dict:
+    """The parts of a yt-dlp option dict that determine the produced file."""
+    return {k: opts.get(k) for k in ("format", "merge_output_format", "postprocessors")}
+
+
+async def _stream(info: dict, fmt: dict, ffmpeg_args: list[str], workdir: str, progress) -> str:
+    """Run run_stream() on the download pool; cancelling stops the transfer and ffmpeg.
+
+    With worker processes it runs in one of them, like every other yt-dlp job.
+    """
+    progress_hook, _ = _make_hooks(progress)
+    args = (_EXTRACT_OPTS, info, fmt, ffmpeg_args, workdir + "/%(title)s.mp3")
+    if _process_pool is not None:
+        # Killing the worker on cancel closes ffmpeg's input, so ffmpeg exits too
+        return await _process_pool.run(scheduler.executor("download"), "stream", args, progress_hook)
+
+    abort = threading.Event()
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(
+        scheduler.executor("download"), partial(run_stream, *args, progress_hook, abort),
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        abort.set()
+        await asyncio.wait([future], timeout=_ABORT_GRACE)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        raise
+
+
+async def _download(
+    info: dict, opts: dict, progress_callback=None, user_id: int = 0, cost: float = 0.0,
+    stream_mp3: str | None = None,
+) -> str:
+    """Download *info* with *opts* through the shared download cache.
+
+    Identical concurrent requests share one download, which takes a single
+    "download" scheduler slot on behalf of *user_id*, ranked by *cost*. The
+    returned path is acquired from download_cache and must be released by the caller.
+
+    With *stream_mp3* (a bitrate in kbps) the audio is piped straight into an
+    MP3 encoder while it downloads; *opts* is the equivalent yt-dlp route, used
+    as the cache key and as the fallback if streaming is not possible.
+    """
+
+    async def produce(workdir: str, progress) -> str:
+        job_opts = dict(opts, outtmpl=workdir + "/%(title)s.%(ext)s")
+        progress_hook, pp_hook = _make_hooks(progress)
+
+        def on_position(pos: int) -> None:
+            progress(f"В очереди на скачивание: {pos}")
+
+        async with scheduler.slot("download", user_id, on_position=on_position, cost=cost):
+            fmt = pick_stream_format(info) if stream_mp3 else None
+            if fmt is not None:
+                ffmpeg_args = [
+                    FFMPEG_PATH, "-y", "-loglevel", "error", "-i", "pipe:0",
+                    "-vn", "-c:a", "libmp3lame", "-b:a", f"{stream_mp3}k",
+                ]
+                try:
+                    return await _stream(info, fmt, ffmpeg_args, workdir, progress)
+                except Exception as e:
+                    logger.warning("Streaming transcode of %s failed, using yt-dlp: %s", info.get("id"), e)
+            result = await _run_ytdl("download", "download", (job_opts, info), progress_hook, pp_hook)
+        return result["requested_downloads"][0]["filepath"]
+
+    key = download_cache.key(info["id"], _cache_settings(opts))
+    return await download_cache.fetch(key, produce, progress_callback)
+
+
+async def download_video(
+    url: str, height: int, progress_callback=None, info: dict | None = None, user_id: int = 0,
+    format_spec: str | None = None,
+) -> tuple[str, str]:
+    """Download video at the given resolution. Returns (file_path, title).
+
+    Pass *info* from resolve_info() to skip the extractor round trip, and
+    *format_spec* (e.g. from fit_format()) to download exact format IDs.
+    Release the returned path with download_cache.release() when done.
+    """
+    if info is None:
+        info = await resolve_info(url)
+
     opts = {
-        "format": f"bestvideo[height<={height}]+bestaudio/best[height<={height}]",
-        "outtmpl": DOWNLOAD_DIR + "/%(title)s.%(ext)s",
+        "format": format_spec or f"bestvideo[height<={height}]+bestaudio/best[height<={height}]",
         "merge_output_format": "mp4",
         "ffmpeg_location": FFMPEG_PATH,
         "quiet": True,
         "no_warnings": True,
     }
 
-    if progress_callback:
-        progress_hook, pp_hook = _make_hooks(progress_callback)
-        opts["progress_hooks"] = [progress_hook]
+    file_path = await _download(info, opts, progress_callback, user_id, video_cost(info, height))
+    return file_path, info.get("title", "video")
 
-    loop = asyncio.get_event_loop()
 
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        if progress_callback:
-            ydl.add_postprocessor_hook(pp_hook)
-        info = await loop.run_in_executor(None, partial(ydl.extract_info, url))
-
-    title = info.get("title", "video")
-    file_path = info["requested_downloads"][0]["filepath"]
-    return file_path, title
+async def download_audio(
+    url: str, bitrate: str = "192", progress_callback=None, info: dict | None = None, user_id: int = 0,
+) -> tuple[str, str]:
+    """Download audio as MP3 (or original format if bitrate='original').
 
+    Pass *info* from resolve_info() to skip the extractor round trip.
+    Release the returned path with download_cache.release() when done.
+    """
+    if info is None:
+        info = await resolve_info(url)
 
-async def download_audio(url: str, bitrate: str = "192", progress_callback=None) -> tuple[str, str]:
-    """Download audio as MP3 (or original format if bitrate='original')."""
     opts = {
         "format": "bestaudio/best",
-        "outtmpl": DOWNLOAD_DIR + "/%(title)s.%(ext)s",
         "ffmpeg_location": FFMPEG_PATH,
         "quiet": True,
         "no_warnings": True,
@@ -173,20 +511,9 @@ async def download_audio(url: str, bitrate: str = "192", progress_callback=None)
             }
         ]
 
-    if progress_callback:
-        progress_hook, pp_hook = _make_hooks(progress_callback)
-        opts["progress_hooks"] = [progress_hook]
-
-    loop = asyncio.get_event_loop()
-
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        if progress_callback:
-            ydl.add_postprocessor_hook(pp_hook)
-        info = await loop.run_in_executor(None, partial(ydl.extract_info, url))
-
-    title = info.get("title", "audio")
-    file_path = info["requested_downloads"][0]["filepath"]
-    return file_path, title
+    stream_mp3 = bitrate if bitrate.isdigit() else None
+    file_path = await _download(info, opts, progress_callback, user_id, audio_cost(info, bitrate), stream_mp3)
+    return file_path, info.get("title", "audio")
 
 
 async def _get_duration(file_path: str) -> float:
@@ -201,7 +528,7 @@ async def _get_duration(file_path: str) -> float:
     loop = asyncio.get_event_loop()
     try:
         result = await loop.run_in_executor(
-            None,
+            scheduler.executor("probe"),
             partial(subprocess.run, probe_cmd, capture_output=True, text=True, timeout=30),
         )
         return float(result.stdout.strip())
@@ -242,10 +569,15 @@ def calculate_bitrate(
             return video_kbps, audio_kbps
 
 
-async def convert_to_mp3(file_path: str, progress_callback=None) -> str:
-    """Convert audio file to MP3 (max VBR quality). Returns mp3 path."""
-    base = os.path.splitext(file_path)[0]
-    mp3_path = f"{base}.mp3"
+async def convert_to_mp3(
+    file_path: str, progress_callback=None, duration: float | None = None, workdir: str | None = None,
+) -> str:
+    """Convert audio file to MP3 (max VBR quality). Returns mp3 path.
+
+    With *duration* known, progress shows percent done and ETA, not only speed.
+    The MP3 goes to *workdir* if given, else next to the source.
+    """
+    mp3_path = f"{output_stem(file_path, workdir)}.mp3"
 
     cmd = [
         FFMPEG_PATH, "-i", file_path,
@@ -253,28 +585,11 @@ async def convert_to_mp3(file_path: str, progress_callback=None) -> str:
         "-y", mp3_path,
     ]
 
-    loop = asyncio.get_event_loop()
-
-    async def _run_with_progress():
-        proc = await asyncio.create_subprocess_exec(
-            *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
-        )
-        elapsed = 0
-        while True:
-            try:
-                await asyncio.wait_for(proc.wait(), timeout=10)
-                break
-            except asyncio.TimeoutError:
-                elapsed += 10
-                if progress_callback:
-                    progress_callback(f"Конвертирую в MP3... {elapsed} сек")
-
-        if proc.returncode != 0:
-            stderr = (await proc.stderr.read()).decode(errors="replace")
-            raise RuntimeError(f"ffmpeg exit code {proc.returncode}: {stderr[:200]}")
-
     try:
-        await _run_with_progress()
+        await run_ffmpeg(
+            cmd, max(600.0, (duration or 0) * 2), duration,
+            text_reporter(progress_callback, "Конвертирую в MP3"), is_audio=True,
+        )
     except Exception as e:
         if os.path.exists(mp3_path):
             os.remove(mp3_path)
@@ -290,13 +605,21 @@ async def compress_file(
     file_path: str,
     video_bitrate_kbps: int,
     audio_bitrate_kbps: int = 128,
+    duration: float | None = None,
+    scale: list[str] = (),
+    progress_callback=None,
+    workdir: str | None = None,
 ) -> tuple[str, int]:
     """Compress a media file using the supplied bitrates.
 
+    *scale* is a compressor.scale_args() result (downscale / frame rate) for video.
+    Long videos (see use_segments) are encoded in parallel segments.
+    *progress_callback(text)* gets percent (if *duration* is given), speed and ETA.
+    The output goes to *workdir* if given, else next to the source.
     Returns (compressed_path, actual_size_bytes).
     Raises RuntimeError if ffmpeg fails or produces no output.
     """
-    base, ext = os.path.splitext(file_path)
+    base, ext = output_stem(file_path, workdir), os.path.splitext(file_path)[1]
     compressed_path = f"{base}_compressed{ext}"
 
     is_audio = ext.lower() in (".mp3", ".m4a", ".aac", ".ogg", ".opus")
@@ -310,6 +633,7 @@ async def compress_file(
     else:
         cmd = [
             FFMPEG_PATH, "-i", file_path,
+            *scale,
             "-b:v", f"{video_bitrate_kbps}k",
             "-b:a", f"{audio_bitrate_kbps}k",
             "-y", compressed_path,
@@ -323,12 +647,22 @@ async def compress_file(
         audio_bitrate_kbps,
     )
 
-    loop = asyncio.get_event_loop()
+    segmented = not is_audio and bool(duration) and use_segments(duration)
+    if segmented:
+        # Segments are joined as H.264/AAC, which only MP4/MKV can hold
+        compressed_path = f"{base}_compressed.mp4"
+
     try:
-        await loop.run_in_executor(
-            None,
-            partial(subprocess.run, cmd, capture_output=True, text=True, timeout=600),
-        )
+        if segmented:
+            await segmented_encode(
+                file_path, compressed_path, duration, [*scale, "-b:v", f"{video_bitrate_kbps}k"], audio_bitrate_kbps,
+                progress_callback=progress_callback,
+            )
+        else:
+            await run_ffmpeg(
+                cmd, max(600.0, (duration or 0) * 2), duration,
+                text_reporter(progress_callback, "Сжимаю"), is_audio=is_audio,
+            )
     except Exception as e:
         logger.error("compress_file ffmpeg error: %s", e)
         if os.path.exists(compressed_path):
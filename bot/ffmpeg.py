@@ -0,0 +1,140 @@
+"""Running ffmpeg as an asyncio subprocess with live -progress reporting."""
+import asyncio
+import logging
+from collections import deque
+
+from bot.scheduler import observe_encode
+
+logger = logging.getLogger(__name__)
+
+_STDERR_TAIL_LINES = 20
+
+
+def format_eta(seconds: float) -> str:
+    if seconds < 60:
+        return f"{max(seconds, 1):.0f} с"
+    return f"{seconds / 60:.0f} мин"
+
+
+class FfmpegProgress:
+    """Latest -progress snapshot of one ffmpeg run."""
+
+    __slots__ = ("duration", "out_seconds", "speed", "finished")
+
+    def __init__(self, duration: float | None) -> None:
+        self.duration = duration
+        self.out_seconds = 0.0
+        self.speed: float | None = None  # x realtime, averaged over the run so far
+        self.finished = False
+
+    def update(self, fields: dict[str, str]) -> None:
+        # out_time_ms is in microseconds too (a long-standing ffmpeg quirk)
+        out_us = fields.get("out_time_us") or fields.get("out_time_ms")
+        if out_us and out_us.lstrip("-").isdigit():
+            self.out_seconds = max(0.0, int(out_us) / 1_000_000)
+        speed = fields.get("speed", "").strip().rstrip("x")
+        try:
+            self.speed = float(speed) or None
+        except ValueError:
+            pass
+        self.finished = fields.get("progress") == "end"
+
+    @property
+    def fraction(self) -> float | None:
+        if not self.duration:
+            return None
+        return min(1.0, self.out_seconds / self.duration)
+
+    @property
+    def eta(self) -> float | None:
+        """Seconds left at the current speed, if the duration is known."""
+        if not self.duration or not self.speed:
+            return None
+        return max(0.0, self.duration - self.out_seconds) / self.speed
+
+
+def progress_text(label: str, fraction: float | None, speed: float | None, eta: float | None) -> str:
+    """A line like "Сжимаю... 45% · 2.1x · осталось ~3 мин"; unknown parts are left out."""
+    text = f"{label}..."
+    if fraction is not None:
+        text += f" {fraction * 100:.0f}%"
+    if speed:
+        text += f" · {speed:.1f}x"
+    if eta:
+        text += f" · осталось ~{format_eta(eta)}"
+    return text
+
+
+def text_reporter(callback, label: str):
+    """An on_progress for run_ffmpeg that sends progress_text() to *callback(text)*; None if no callback."""
+    if callback is None:
+        return None
+
+    def on_progress(progress: FfmpegProgress) -> None:
+        callback(progress_text(label, progress.fraction, progress.speed, progress.eta))
+
+    return on_progress
+
+
+async def run_ffmpeg(
+    cmd: list[str],
+    timeout: float,
+    duration: float | None = None,
+    on_progress=None,
+    is_audio: bool | None = None,
+) -> FfmpegProgress:
+    """Run an ffmpeg command line; raise RuntimeError on failure or timeout.
+
+    ``-progress pipe:1`` is added and parsed as it arrives: *on_progress* gets
+    the FfmpegProgress (fraction of *duration*, speed, ETA) on the event loop
+    about twice a second. Stderr is drained all the time, so ffmpeg never
+    blocks on a full pipe; its tail goes into the error message. Pass
+    *is_audio* for full-length encodes so the scheduler learns the real speed.
+    """
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    progress = FfmpegProgress(duration)
+    tail: deque[str] = deque(maxlen=_STDERR_TAIL_LINES)
+
+    async def drain_stderr() -> None:
+        async for line in proc.stderr:
+            tail.append(line.decode(errors="replace").rstrip())
+
+    async def read_progress() -> None:
+        fields: dict[str, str] = {}
+        async for line in proc.stdout:
+            key, _, value = line.decode(errors="replace").strip().partition("=")
+            fields[key] = value
+            if key != "progress":
+                continue
+            progress.update(fields)
+            fields = {}
+            if on_progress:
+                try:
+                    on_progress(progress)
+                except Exception:
+                    logger.debug("ffmpeg on_progress callback failed", exc_info=True)
+
+    readers = asyncio.gather(drain_stderr(), read_progress())
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"ffmpeg timed out after {timeout:.0f} s") from None
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        # Both pipes reach EOF once ffmpeg is gone
+        await readers
+
+    if proc.returncode != 0:
+        stderr = "\n".join(tail)
+        raise RuntimeError(f"ffmpeg exit code {proc.returncode}: {stderr[-300:]}")
+    if is_audio is not None and progress.speed:
+        observe_encode(is_audio, progress.speed)
+    return progress
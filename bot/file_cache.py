@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+from bot.config import DOWNLOAD_CACHE_SIZE, DOWNLOAD_DIR
+
+logger = logging.getLogger(__name__)
+
+# Written into an entry directory once the download and post-processing finished
+_COMPLETE_MARKER = ".complete"
+# Unfinished entries (yt-dlp .part files) are resumed by the next identical download; older ones are dropped
+_PARTIAL_TTL = 86400
+
+
+def _last_write(directory: str) -> float:
+    """Latest mtime of *directory* and the files in it (a .part file grows without touching the directory)."""
+    return max([os.path.getmtime(directory)] + [entry.stat().st_mtime for entry in os.scandir(directory)])
+
+
+class _InFlight:
+    """A running download that every identical request subscribes to."""
+
+    def __init__(self) -> None:
+        self.task: asyncio.Task | None = None
+        self.subscribers: list = []
+        self.waiters = 0
+        # References taken for the waiters when the file was finished, not yet claimed by them
+        self.refs = 0
+
+    def progress(self, text: str) -> None:
+        for callback in list(self.subscribers):
+            try:
+                callback(text)
+            except Exception:
+                logger.debug("Progress subscriber failed", exc_info=True)
+
+
+class DownloadCache:
+    """Content-addressed store of finished downloads with single-flight production.
+
+    Entries live in ``<root>/<key>/`` and are keyed by (video ID, format selector,
+    postprocessor settings). Paths handed out by fetch() are reference counted;
+    eviction and release() never delete a file that is still being sent.
+    With ``max_bytes == 0`` nothing is kept once the last reference is released.
+
+    A failed or cancelled download is removed, except after keep_partial():
+    then it stays for the next start, and the same download picks up where it
+    stopped since the entry directory is the same.
+
+    Nothing on disk is touched until scan(), which only the worker owning the
+    download directory calls: reference counts are per process, so another
+    process sharing the directory must never evict.
+    """
+
+    def __init__(self, root: str, max_bytes: int) -> None:
+        self._root = root
+        self._max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[str, int]] = OrderedDict()  # key -> (path, size)
+        self._refs: dict[str, int] = {}
+        self._inflight: dict[str, _InFlight] = {}
+        self._keep_partial = False
+
+    @staticmethod
+    def key(video_id: str, settings: dict) -> str:
+        """Return the cache key for a video and its format/postprocessor settings."""
+        raw = json.dumps([video_id, settings], sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+    def scan(self) -> None:
+        """Re-index entries left on disk by a previous run (oldest first); call once at worker startup."""
+        os.makedirs(self._root, exist_ok=True)
+        found = []
+        partial = 0
+        for key in os.listdir(self._root):
+            marker = os.path.join(self._root, key, _COMPLETE_MARKER)
+            try:
+                with open(marker) as f:
+                    path = os.path.join(self._root, key, f.read().strip())
+                found.append((os.path.getmtime(marker), key, path, os.path.getsize(path)))
+            except OSError:
+                workdir = os.path.join(self._root, key)
+                try:
+                    stale = time.time() - _last_write(workdir) > _PARTIAL_TTL
+                except OSError:
+                    continue
+                if stale:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                else:
+                    partial += 1
+        for _, key, path, size in sorted(found):
+            self._entries[key] = (path, size)
+        if found or partial:
+            logger.info("Download cache: %d entries restored, %d partial downloads to resume", len(found), partial)
+        self._evict()
+
+    def _lookup(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        path = entry[0]
+        if not os.path.exists(path):
+            # Removed behind our back (manual cleanup, /cancel)
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return path
+
+    def _acquire(self, path: str) -> str:
+        self._refs[path] = self._refs.get(path, 0) + 1
+        return path
+
+    def _total_bytes(self) -> int:
+        return sum(size for _, size in self._entries.values())
+
+    def _evict(self) -> None:
+        total = self._total_bytes()
+        for key in list(self._entries):
+            if total <= self._max_bytes:
+                break
+            path, size = self._entries[key]
+            if self._refs.get(path):
+                continue
+            del self._entries[key]
+            total -= size
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            logger.info("Download cache: evicted %s (%.1f MB)", path, size / 1024 / 1024)
+
+    async def _produce(self, key: str, producer, flight: _InFlight) -> str:
+        workdir = os.path.join(self._root, key)
+        os.makedirs(workdir, exist_ok=True)
+        try:
+            path = await producer(workdir, flight.progress)
+        except BaseException:
+            if not self._keep_partial:
+                shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        with open(os.path.join(workdir, _COMPLETE_MARKER), "w") as f:
+            f.write(os.path.relpath(path, workdir))
+        self._entries[key] = (path, os.path.getsize(path))
+        # Referenced for the waiters before any of them resumes, so nothing evicts it in between
+        flight.refs = flight.waiters
+        self._refs[path] = self._refs.get(path, 0) + flight.waiters
+        return path
+
+    def _claim(self, flight: _InFlight, path: str) -> str:
+        """Take a reference _produce() set aside for a waiter, or a new one for a late joiner."""
+        if flight.refs:
+            flight.refs -= 1
+            return path
+        return self._acquire(path)
+
+    async def fetch(self, key: str, producer, progress_callback=None) -> str:
+        """Return the file for *key*, producing it at most once across concurrent callers.
+
+        *producer* is ``async (workdir, progress_callback) -> file_path``. The returned
+        path is acquired; pass it to release() when done with it.
+        """
+        path = self._lookup(key)
+        if path is not None:
+            logger.info("Download cache hit: %s", path)
+            return self._acquire(path)
+
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = _InFlight()
+            flight.task = asyncio.ensure_future(self._produce(key, producer, flight))
+            flight.task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self._inflight[key] = flight
+        else:
+            logger.info("Joining in-flight download %s", key)
+
+        if progress_callback:
+            flight.subscribers.append(progress_callback)
+        flight.waiters += 1
+        try:
+            # Shielded: one waiter giving up must not abort the download for the others
+            path = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # ...but when the last one gives up, nobody needs it any more
+            if flight.waiters == 1 and not flight.task.done():
+                logger.info("Download %s abandoned by all requesters, stopping it", key)
+                flight.task.cancel()
+            elif flight.task.done() and not flight.task.cancelled() and flight.task.exception() is None:
+                # Cancelled after the file was finished: give back the reference taken for us
+                self.release(self._claim(flight, flight.task.result()))
+            raise
+        finally:
+            flight.waiters -= 1
+            if progress_callback:
+                flight.subscribers.remove(progress_callback)
+
+        self._claim(flight, path)
+        self._evict()
+        return path
+
+    def keep_partial(self) -> None:
+        """Keep the partial files of downloads interrupted from now on (call before shutting down)."""
+        self._keep_partial = True
+
+    def release(self, path: str | None) -> None:
+        """Drop one reference to *path*; delete it if it is no longer cached or used."""
+        if not path:
+            return
+        refs = self._refs.get(path, 0) - 1
+        if refs > 0:
+            self._refs[path] = refs
+            return
+        self._refs.pop(path, None)
+        if any(entry[0] == path for entry in self._entries.values()):
+            self._evict()
+            return
+        # Not (or no longer) a cache entry: nothing else can use it
+        if os.path.exists(path):
+            os.remove(path)
+
+
+download_cache = DownloadCache(os.path.join(DOWNLOAD_DIR, "cache"), DOWNLOAD_CACHE_SIZE)
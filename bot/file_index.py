@@ -0,0 +1,62 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from bot.config import FILE_ID_DB
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdIndex:
+    """Persistent map of (video ID, variant) -> Telegram file_id of an already sent file.
+
+    Variants look like ``video:720``, ``audio:192``, ``video:1080:compressed`` or
+    ``audio:original:mp3``. ``kind`` is the attachment type Telegram returned
+    (document, audio, video) and selects the send method for re-sending.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            " video_id TEXT NOT NULL,"
+            " variant TEXT NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " file_id TEXT NOT NULL,"
+            " file_size INTEGER,"
+            " created REAL NOT NULL,"
+            " PRIMARY KEY (video_id, variant))"
+        )
+        self._db.commit()
+
+    def get(self, video_id: str, variant: str) -> tuple[str, str] | None:
+        """Return (kind, file_id) for a previously sent variant, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT kind, file_id FROM file_ids WHERE video_id = ? AND variant = ?",
+                (video_id, variant),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put(self, video_id: str, variant: str, kind: str, file_id: str, file_size: int | None) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?, ?, ?, ?)",
+                (video_id, variant, kind, file_id, file_size, time.time()),
+            )
+            self._db.commit()
+
+    def remove(self, video_id: str, variant: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM file_ids WHERE video_id = ? AND variant = ?", (video_id, variant)
+            )
+            self._db.commit()
+
+
+file_index = FileIdIndex(FILE_ID_DB)
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
+
+from bot.config import INFO_CACHE_DB, INFO_CACHE_SIZE, INFO_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Signed googlevideo URLs carry their own expiry; treat them as stale a bit early
+_URL_EXPIRY_MARGIN = 10 * 60
+# Used when no format URL exposes an expiry timestamp
+_DEFAULT_URL_TTL = 60 * 60
+_MANIFEST_EXPIRE_RE = re.compile(r"/expire/(\d+)")
+
+# Large fields nobody reads after extraction; dropping them keeps entries small
+_HEAVY_KEYS = ("automatic_captions", "subtitles", "heatmap")
+
+
+def _url_expiry(url: str) -> float | None:
+    parsed = urlparse(url)
+    values = parse_qs(parsed.query).get("expire")
+    if values and values[0].isdigit():
+        return float(values[0])
+    m = _MANIFEST_EXPIRE_RE.search(parsed.path)
+    if m:
+        return float(m.group(1))
+    return None
+
+
+def formats_expiry(info: dict) -> float:
+    """Return the earliest timestamp at which any format URL in *info* stops working."""
+    expiries = []
+    for f in info.get("formats") or []:
+        for key in ("url", "manifest_url", "fragment_base_url"):
+            if f.get(key):
+                exp = _url_expiry(f[key])
+                if exp:
+                    expiries.append(exp)
+    if expiries:
+        return min(expiries) - _URL_EXPIRY_MARGIN
+    return time.time() + _DEFAULT_URL_TTL
+
+
+class InfoCache:
+    """Metadata cache keyed by YouTube video ID: in-memory LRU plus optional sqlite tier.
+
+    Each entry holds the keyboard summary (valid for ``ttl`` seconds) and the raw
+    yt-dlp info dict, which is only handed out while its signed format URLs are valid.
+    """
+
+    def __init__(self, max_entries: int, ttl: int, db_path: str = "") -> None:
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._memory: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path: str) -> None:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS info_cache ("
+                " video_id TEXT PRIMARY KEY,"
+                " summary TEXT NOT NULL,"
+                " info TEXT,"
+                " expires REAL NOT NULL,"
+                " urls_expire REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM info_cache WHERE expires < ?", (time.time(),))
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning("Info cache DB %s unavailable, memory only: %s", db_path, e)
+            self._db = None
+
+    def _load(self, video_id: str) -> dict | None:
+        entry = self._memory.get(video_id)
+        if entry is not None:
+            self._memory.move_to_end(video_id)
+            return entry
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            "SELECT summary, info, expires, urls_expire FROM info_cache WHERE video_id = ?",
+            (video_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        entry = {
+            "summary": json.loads(row[0]),
+            "info": json.loads(row[1]) if row[1] else None,
+            "expires": row[2],
+            "urls_expire": row[3],
+        }
+        self._remember(video_id, entry)
+        return entry
+
+    def _remember(self, video_id: str, entry: dict) -> None:
+        self._memory[video_id] = entry
+        self._memory.move_to_end(video_id)
+        while len(self._memory) > self._max_entries:
+            self._memory.popitem(last=False)
+
+    def _drop(self, video_id: str) -> None:
+        self._memory.pop(video_id, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM info_cache WHERE video_id = ?", (video_id,))
+            self._db.commit()
+
+    def get_summary(self, video_id: str) -> dict | None:
+        """Return the cached get_video_info() result, or None on miss/expiry."""
+        with self._lock:
+            entry = self._load(video_id)
+            if entry is None:
+                return None
+            if entry["expires"] < time.time():
+                self._drop(video_id)
+                return None
+            return entry["summary"]
+
+    def get_info(self, video_id: str) -> dict | None:
+        """Return the cached raw info dict only while its format URLs are still valid."""
+        with self._lock:
+            entry = self._load(video_id)
+            if entry is None or entry["info"] is None:
+                return None
+            if entry["urls_expire"] < time.time():
+                # Summary stays usable; only the signed URLs went stale
+                entry["info"] = None
+                return None
+            return entry["info"]
+
+    def put(self, video_id: str, summary: dict, info: dict | None = None) -> None:
+        if info is not None:
+            info = {k: v for k, v in info.items() if k not in _HEAVY_KEYS}
+        entry = {
+            "summary": summary,
+            "info": info,
+            "expires": time.time() + self._ttl,
+            "urls_expire": formats_expiry(info) if info else 0.0,
+        }
+        with self._lock:
+            self._remember(video_id, entry)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO info_cache VALUES (?, ?, ?, ?, ?)",
+                    (
+                        video_id,
+                        json.dumps(summary),
+                        json.dumps(info) if info else None,
+                        entry["expires"],
+                        entry["urls_expire"],
+                    ),
+                )
+                self._db.commit()
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                logger.warning("Could not persist info for %s: %s", video_id, e)
+
+
+info_cache = InfoCache(INFO_CACHE_SIZE, INFO_CACHE_TTL, INFO_CACHE_DB)
@@ -0,0 +1,110 @@
+"""Per-user job registry: every long operation gets its own workspace and can be cancelled."""
+import asyncio
+import itertools
+import logging
+import os
+import shutil
+from contextlib import asynccontextmanager
+
+from bot.config import DOWNLOAD_DIR
+
+logger = logging.getLogger(__name__)
+
+
+def _alive(pid: str) -> bool:
+    """Whether the process named by a workspace directory still runs (non-pid names count as gone)."""
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Job:
+    """One running operation of a user: its task, its working directory and whether /cancel hit it."""
+
+    __slots__ = ("id", "user_id", "kind", "workdir", "task", "cancelled")
+
+    def __init__(self, job_id: int, user_id: int, kind: str, workdir: str) -> None:
+        self.id = job_id
+        self.user_id = user_id
+        self.kind = kind
+        self.workdir = workdir
+        self.task = asyncio.current_task()
+        self.cancelled = False
+
+
+class JobRegistry:
+    """Running jobs by user, so /cancel stops exactly that user's work.
+
+    A job is the worker task running it: cancelling it interrupts whatever it
+    is awaiting. ffmpeg processes are killed by run_ffmpeg, yt-dlp stops at its
+    next progress hook, and a download shared with other users keeps running
+    for them. A job's directory is removed when the job ends, however it ends.
+
+    Workspaces live in ``<root>/<pid>/``: several processes (the bot, workers)
+    may share the root, and each only ever cleans up its own and dead ones'.
+    """
+
+    def __init__(self, root: str) -> None:
+        self._parent = root
+        self._root = os.path.join(root, str(os.getpid()))
+        self._jobs: dict[int, set[Job]] = {}
+        self._ids = itertools.count(1)
+
+    def clean_up(self) -> None:
+        """Remove workspaces left by processes that are gone (call once at startup)."""
+        os.makedirs(self._parent, exist_ok=True)
+        for name in os.listdir(self._parent):
+            path = os.path.join(self._parent, name)
+            if name == str(os.getpid()) or not _alive(name):
+                shutil.rmtree(path, ignore_errors=True)
+
+    @asynccontextmanager
+    async def run(self, user_id: int, kind: str):
+        """Run the block as a job of *user_id*; yields the Job.
+
+        Cancellation by cancel_user() ends the block quietly (check
+        ``job.cancelled`` afterwards); any other cancellation propagates.
+        """
+        job_id = next(self._ids)
+        job = Job(job_id, user_id, kind, os.path.join(self._root, f"{user_id}-{job_id}"))
+        os.makedirs(job.workdir)
+        self._jobs.setdefault(user_id, set()).add(job)
+        try:
+            yield job
+        except asyncio.CancelledError:
+            if not job.cancelled:
+                raise
+            job.task.uncancel()
+            logger.info("Job %d (%s) of user %d cancelled", job.id, kind, user_id)
+        finally:
+            running = self._jobs.get(user_id)
+            if running is not None:
+                running.discard(job)
+                if not running:
+                    del self._jobs[user_id]
+            shutil.rmtree(job.workdir, ignore_errors=True)
+
+    def cancel_user(self, user_id: int) -> int:
+        """Cancel every running job of *user_id*; returns how many there were."""
+        running = self._jobs.get(user_id, set())
+        for job in running:
+            job.cancelled = True
+            job.task.cancel()
+        return len(running)
+
+    def cancel_task(self, task: asyncio.Task) -> bool:
+        """Cancel just the job *task* is running; returns False if it runs none."""
+        for running in self._jobs.values():
+            for job in running:
+                if job.task is task:
+                    job.cancelled = True
+                    task.cancel()
+                    return True
+        return False
+
+
+jobs = JobRegistry(os.path.join(DOWNLOAD_DIR, "jobs"))
@@ -1,8 +1,37 @@
 import logging
 from telegram import BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+from telegram.ext import (
+    Application,
+    CallbackQueryHandler,
+    CommandHandler,
+    MessageHandler,
+    PersistenceInput,
+    PicklePersistence,
+    filters,
+)
 from telegram.request import HTTPXRequest
-from bot.config import BOT_TOKEN, LOCAL_API_URL
+from bot.config import (
+    BOT_TOKEN,
+    BOT_WORKER_JOBS,
+    CONCURRENT_UPDATES,
+    JOB_QUEUE_DB,
+    LOCAL_API_URL,
+    QUEUE_FILES_SET,
+    STATE_FILE,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+)
+from bot.downloader import start_workers, stop_workers
+from bot.jobs import jobs
+from bot.ratelimit import PriorityRateLimiter
+from bot.updates import OrderedUpdateProcessor
+from bot.upload import bot_request
+from bot.webdav import webdav
+from bot.work_queue import work_queue
+from bot.worker import Worker
 from bot.handlers import (
     start_command,
     help_command,
@@ -15,25 +44,38 @@ from bot.handlers import (
     cancel_command,
 )
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
 logger = logging.getLogger(__name__)
 
+_STATE_FLUSH_INTERVAL = 5
 
-def main() -> None:
-    builder = Application.builder().token(BOT_TOKEN)
 
-    if LOCAL_API_URL:
+def build_application(local_api_url: str = LOCAL_API_URL) -> Application:
+    """The bot with its handlers and its worker, talking to *local_api_url* if set, else to Telegram."""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(PriorityRateLimiter())
+        # Users are served in parallel; /cancel gets through while that user's download is running
+        .concurrent_updates(OrderedUpdateProcessor(CONCURRENT_UPDATES))
+        # getUpdates holds its one connection for the whole long poll
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, read_timeout=10, connect_timeout=10))
+        .request(bot_request())
+        # Only user_data is used; it is written out every few seconds, not on every update
+        .persistence(PicklePersistence(
+            STATE_FILE,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=_STATE_FLUSH_INTERVAL,
+        ))
+    )
+
+    if local_api_url:
         builder = (
             builder
-            .base_url(f"{LOCAL_API_URL}/bot")
-            .base_file_url(f"{LOCAL_API_URL}/file/bot")
+            .base_url(f"{local_api_url}/bot")
+            .base_file_url(f"{local_api_url}/file/bot")
             .local_mode(True)
-            .request(HTTPXRequest(read_timeout=300, write_timeout=300, connect_timeout=30))
         )
-        logger.info("Using Local Bot API Server at %s", LOCAL_API_URL)
+        logger.info("Using Local Bot API Server at %s", local_api_url)
 
     application = builder.build()
 
@@ -47,17 +89,65 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(compress_callback, pattern="^compress:"))
     application.add_handler(CallbackQueryHandler(convert_callback, pattern="^convert:"))
 
+    # Handlers only queue jobs; this worker (and any python -m bot.worker) runs them
+    worker = Worker(application.bot, work_queue, BOT_WORKER_JOBS) if BOT_WORKER_JOBS > 0 else None
+
     async def post_init(app: Application) -> None:
+        start_workers()
+        if worker is not None:
+            await worker.start()
         await app.bot.set_my_commands([
             BotCommand("start", "Запустить бота"),
             BotCommand("help", "Справка"),
             BotCommand("cancel", "Отменить текущую операцию"),
         ])
 
+    async def post_stop(app: Application) -> None:
+        if worker is not None:
+            await worker.stop()
+
+    async def post_shutdown(app: Application) -> None:
+        stop_workers()
+        if webdav is not None:
+            await webdav.close()
+
     application.post_init = post_init
+    application.post_stop = post_stop
+    application.post_shutdown = post_shutdown
+    return application
+
 
-    logger.info("Bot started")
-    application.run_polling(drop_pending_updates=True)
+def main() -> None:
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    if BOT_WORKER_JOBS == 0 and not QUEUE_FILES_SET:
+        raise ValueError(
+            "BOT_WORKER_JOBS=0 leaves the jobs to python -m bot.worker: "
+            "set JOB_QUEUE_DB and FILE_ID_DB to files the workers share"
+        )
+    # Workers check that they were pointed at the queue the bot fills
+    work_queue.announce_bot()
+    logger.info("Job queue: %s", JOB_QUEUE_DB)
+    jobs.clean_up()
+    application = build_application()
+
+    # Updates that arrived while the bot was down are processed, not dropped
+    if WEBHOOK_URL:
+        logger.info(
+            "Bot started (webhook %s/%s, listening on %s:%d)", WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_LISTEN, WEBHOOK_PORT,
+        )
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+        )
+    else:
+        logger.info("Bot started (polling)")
+        application.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+"""Coalescing progress messages: producers never wait on Telegram."""
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from bot.ratelimit import PROGRESS, retry_seconds
+
+logger = logging.getLogger(__name__)
+
+# Per-message edit interval: starts at the minimum, doubles on errors, decays on success
+_MIN_INTERVAL = 2.0
+_MAX_INTERVAL = 30.0
+# Telegram allows about one message per second per chat; edits count too
+_CHAT_INTERVAL = 1.0
+# A flusher with nothing to send for this long exits; the next update restarts it
+_IDLE_TIMEOUT = 60.0
+
+_channels: dict[tuple[int, int], "ProgressChannel"] = {}
+# chat_id -> monotonic time before which no other progress edit goes to that chat
+_chat_next: dict[int, float] = {}
+
+
+class ProgressChannel:
+    """Latest progress text of one status message, flushed by a single task.
+
+    Calling the channel with a text (from any thread) only stores it and wakes
+    the flusher; intermediate texts are dropped. The flusher edits the message
+    no faster than its adaptive interval and the per-chat spacing allow, and
+    backs off on RetryAfter and network errors. close() discards whatever is
+    still pending, so call it before editing the message directly.
+    """
+
+    def __init__(self, bot, chat_id: int, message_id: int) -> None:
+        self._bot = bot
+        self._chat_id = chat_id
+        self._message_id = message_id
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._latest = ""
+        self._sent = ""
+        self._wake_pending = False
+        self._closed = False
+        self._interval = _MIN_INTERVAL
+        self._next = 0.0
+
+    def __call__(self, text: str) -> None:
+        if self._closed:
+            return
+        self._latest = text
+        if not self._wake_pending:
+            self._wake_pending = True
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        self._wake_pending = False
+        if self._closed:
+            return
+        self._event.set()
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._event.wait(), _IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return
+                now = time.monotonic()
+                delay = max(self._next, _chat_next.get(self._chat_id, 0.0)) - now
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._event.clear()
+                text = self._latest
+                if text == self._sent:
+                    continue
+                await self._flush(text)
+        finally:
+            self._task = None
+
+    async def _flush(self, text: str) -> None:
+        _chat_next[self._chat_id] = time.monotonic() + _CHAT_INTERVAL
+        try:
+            await self._bot.edit_message_text(
+                chat_id=self._chat_id, message_id=self._message_id, text=text, rate_limit_args=PROGRESS,
+            )
+            self._sent = text
+            self._interval = max(_MIN_INTERVAL, self._interval * 0.75)
+        except RetryAfter as e:
+            wait = retry_seconds(e.retry_after)
+            logger.info("Progress edits to chat %s flood-limited for %.0f s", self._chat_id, wait)
+            _chat_next[self._chat_id] = time.monotonic() + wait
+            self._interval = min(_MAX_INTERVAL, self._interval * 2)
+            self._event.set()
+        except BadRequest:
+            # "Message is not modified" or the message is gone: nothing to retry
+            self._sent = text
+        except NetworkError:
+            self._interval = min(_MAX_INTERVAL, self._interval * 2)
+            self._event.set()
+        self._next = time.monotonic() + self._interval
+
+    def close(self) -> None:
+        """Stop publishing; pending text is dropped and an in-flight edit cancelled."""
+        self._closed = True
+        if _channels.get((self._chat_id, self._message_id)) is self:
+            del _channels[(self._chat_id, self._message_id)]
+        if self._task is not None:
+            self._task.cancel()
+
+
+def progress_channel(bot, chat_id: int, message_id: int) -> ProgressChannel:
+    """The open channel for a status message, created on first use. Call on the event loop."""
+    channel = _channels.get((chat_id, message_id))
+    if channel is None:
+        channel = _channels[(chat_id, message_id)] = ProgressChannel(bot, chat_id, message_id)
+    return channel
@@ -0,0 +1,182 @@
+"""Outbound Bot API rate limiting with priorities: deliveries first, progress edits last."""
+import asyncio
+import datetime as dt
+import heapq
+import itertools
+import logging
+import math
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from bot.upload import MEDIA_ENDPOINTS
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lowest value goes first. Pass PROGRESS as rate_limit_args
+# for edits that may be dropped when the chat or the bot is busy.
+DELIVERY = 0
+PROMPT = 1
+PROGRESS = 2
+
+# Telegram: ~30 messages/s overall, ~1/s per private chat, 20/min per group
+_GLOBAL_RATE, _GLOBAL_BURST = 30.0, 30.0
+_PRIVATE_RATE, _PRIVATE_BURST = 1.0, 3.0
+_GROUP_RATE, _GROUP_BURST = 20 / 60, 5.0
+_MAX_RETRIES = 3
+
+
+def retry_seconds(retry_after) -> float:
+    """RetryAfter.retry_after in seconds."""
+    # int in older python-telegram-bot releases, timedelta in newer ones
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+class _Bucket:
+    """Token bucket that can also be paused until a point in time (after a 429)."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait(self, now: float) -> float:
+        """Seconds until one token is available (0 if now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Global and per-chat token buckets with one prioritized waiting line.
+
+    Requests without a chat_id (getUpdates, answerCallbackQuery, ...) are not
+    limited. Of the waiting requests, the highest-priority one whose chat has
+    a token goes next; file deliveries outrank prompts and status texts.
+    Progress edits never wait: if they would, they fail at once with a
+    synthetic RetryAfter, which ProgressChannel treats as a back-off. A real
+    429 pauses the chat; other requests are then retried, progress edits not.
+    """
+
+    def __init__(self) -> None:
+        self._global = _Bucket(_GLOBAL_RATE, _GLOBAL_BURST)
+        self._chats: dict[int | str, _Bucket] = {}
+        self._waiting: list[list] = []
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+
+    async def initialize(self) -> None:
+        # ExtBot calls this on every bot.initialize(), not just the first
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def _chat(self, chat_id: int | str) -> _Bucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = self._chats[chat_id] = (
+                _Bucket(_GROUP_RATE, _GROUP_BURST) if is_group else _Bucket(_PRIVATE_RATE, _PRIVATE_BURST)
+            )
+        return bucket
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._waiting = [entry for entry in self._waiting if not entry[3].done()]
+            heapq.heapify(self._waiting)
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            global_wait = self._global.wait(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            granted = None
+            soonest = math.inf
+            for entry in sorted(self._waiting):
+                chat_wait = self._chat(entry[2]).wait(now)
+                if chat_wait <= 0:
+                    granted = entry
+                    break
+                soonest = min(soonest, chat_wait)
+            if granted is not None:
+                self._waiting.remove(granted)
+                self._global.take()
+                self._chat(granted[2]).take()
+                granted[3].set_result(None)
+                continue
+
+            # Nobody can go yet: sleep until the first chat frees up or a new request arrives
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), soonest)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, priority: int, chat_id: int | str) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, [priority, next(self._seq), chat_id, future])
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._dispatcher is None:
+            return await callback(*args, **kwargs)
+
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif endpoint in MEDIA_ENDPOINTS:
+            priority = DELIVERY
+        else:
+            priority = PROMPT
+
+        if priority == PROGRESS:
+            now = time.monotonic()
+            wait = max(self._global.wait(now), self._chat(chat_id).wait(now))
+            if wait > 0 or any(entry[2] == chat_id for entry in self._waiting):
+                raise RetryAfter(dt.timedelta(seconds=max(1, math.ceil(wait))))
+            self._global.take()
+            self._chat(chat_id).take()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._chat(chat_id).pause(retry_seconds(e.retry_after))
+                raise
+
+        retries = 0
+        while True:
+            await self._acquire(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                seconds = retry_seconds(e.retry_after)
+                self._chat(chat_id).pause(seconds)
+                retries += 1
+                if retries > _MAX_RETRIES:
+                    raise
+                logger.warning(
+                    "%s to chat %s hit flood control, retrying in %.0f s", endpoint, chat_id, seconds,
+                )
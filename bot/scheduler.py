@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from bot.config import DOWNLOAD_SLOTS, FFMPEG_SLOTS, JOBS_PER_USER, PROBE_SLOTS, SCHEDULER_AGING
+
+logger = logging.getLogger(__name__)
+
+# Rough throughput figures; they only need to rank jobs against each other
+_DOWNLOAD_BYTES_PER_SEC = 4 * 1024 * 1024
+_VIDEO_ENCODE_RATIO = 1.0   # seconds of encoding per second of video
+_AUDIO_ENCODE_RATIO = 0.05  # seconds of encoding per second of audio
+_UNKNOWN_DURATION = 600.0
+# Finished ffmpeg runs pull the encode ratios towards the speed they measured
+_RATIO_SMOOTHING = 0.3
+
+_encode_ratios = {False: _VIDEO_ENCODE_RATIO, True: _AUDIO_ENCODE_RATIO}
+
+
+def download_cost(size_bytes: float | None, duration: float | None) -> float:
+    """Estimated seconds a download will hold its slot."""
+    if not size_bytes:
+        # ~2 Mbit/s average when yt-dlp knows no sizes
+        size_bytes = (duration or _UNKNOWN_DURATION) * 250_000
+    return size_bytes / _DOWNLOAD_BYTES_PER_SEC
+
+
+def encode_cost(duration: float | None, is_audio: bool) -> float:
+    """Estimated seconds an ffmpeg job over *duration* seconds of media will take."""
+    return (duration or _UNKNOWN_DURATION) * _encode_ratios[is_audio]
+
+
+def observe_encode(is_audio: bool, speed: float) -> None:
+    """Feed the average speed (x realtime) of a finished full-length encode into encode_cost()."""
+    ratio = 1 / speed
+    _encode_ratios[is_audio] += _RATIO_SMOOTHING * (ratio - _encode_ratios[is_audio])
+    logger.debug("%s encode ratio now %.3f", "Audio" if is_audio else "Video", _encode_ratios[is_audio])
+
+
+class _Waiter:
+    __slots__ = ("user_id", "future", "on_position", "position", "cost", "enqueued")
+
+    def __init__(self, user_id: int, on_position, cost: float) -> None:
+        self.user_id = user_id
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = 0
+        self.cost = cost
+        self.enqueued = time.monotonic()
+
+    def score(self, now: float, aging: float) -> float:
+        """Expected cost minus credit for time already spent waiting; lowest runs first."""
+        return self.cost - aging * (now - self.enqueued)
+
+
+class Pool:
+    """A bounded resource (download, cpu, probe) shared between users.
+
+    At most ``limit`` jobs run at once and at most ``per_user`` of them belong to
+    the same user. Waiting jobs run shortest-expected-job-first: each carries a
+    cost estimate in seconds, and every second spent waiting takes ``aging``
+    seconds off it, so large jobs move up steadily and never starve. Ties go to
+    the least recently served user.
+    """
+
+    def __init__(self, name: str, limit: int, per_user: int, aging: float) -> None:
+        self.name = name
+        self.limit = max(1, limit)
+        self.per_user = max(1, per_user)
+        self.aging = aging
+        self.executor = ThreadPoolExecutor(max_workers=self.limit, thread_name_prefix=name)
+        self._active = 0
+        self._running: dict[int, int] = {}
+        self._queues: OrderedDict[int, deque[_Waiter]] = OrderedDict()
+        # user_id -> tick of the last slot granted to that user; lowest goes next
+        self._served: dict[int, int] = {}
+        self._tick = 0
+
+    def _eligible(self, user_id: int) -> bool:
+        return self._running.get(user_id, 0) < self.per_user
+
+    def _rotation(self) -> list[int]:
+        """Users with waiters, least recently served first."""
+        return sorted(self._queues, key=lambda uid: self._served.get(uid, 0))
+
+    def _pick(self, queues: dict[int, list[_Waiter]], users: list[int], now: float) -> _Waiter | None:
+        """Lowest-score waiter among *users* (already in rotation order)."""
+        best = None
+        for uid in users:
+            for waiter in queues[uid]:
+                if best is None or waiter.score(now, self.aging) < best.score(now, self.aging):
+                    best = waiter
+        return best
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        while self._active < self.limit:
+            eligible = [uid for uid in self._rotation() if self._eligible(uid)]
+            waiter = self._pick(self._queues, eligible, now)
+            if waiter is None:
+                break
+            user_id = waiter.user_id
+            self._queues[user_id].remove(waiter)
+            if not self._queues[user_id]:
+                del self._queues[user_id]
+            self._tick += 1
+            self._served[user_id] = self._tick
+            self._active += 1
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            waiter.future.set_result(None)
+        self._notify_positions()
+
+    def _projected_order(self) -> list[_Waiter]:
+        """Waiters in the order they would start if nothing else arrived."""
+        now = time.monotonic()
+        users = self._rotation()
+        queues = {uid: list(self._queues[uid]) for uid in users}
+        order = []
+        while True:
+            waiter = self._pick(queues, users, now)
+            if waiter is None:
+                return order
+            queues[waiter.user_id].remove(waiter)
+            order.append(waiter)
+
+    def _notify_positions(self) -> None:
+        for pos, waiter in enumerate(self._projected_order(), start=1):
+            if waiter.position == pos:
+                continue
+            waiter.position = pos
+            if waiter.on_position:
+                try:
+                    waiter.on_position(pos)
+                except Exception:
+                    logger.debug("on_position callback failed", exc_info=True)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        queue = self._queues.get(waiter.user_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.user_id]
+        self._notify_positions()
+
+    def _release(self, user_id: int) -> None:
+        self._active -= 1
+        self._running[user_id] -= 1
+        if not self._running[user_id]:
+            del self._running[user_id]
+            if user_id not in self._queues:
+                self._served.pop(user_id, None)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, on_position=None, cost: float = 0.0):
+        """Hold one slot of this pool for the duration of the block.
+
+        *cost* is the expected run time in seconds (see download_cost/encode_cost).
+        *on_position* is called on the event loop with the 1-based queue position
+        whenever it changes while the job is waiting.
+        """
+        waiter = _Waiter(user_id, on_position, cost)
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(user_id)
+            else:
+                self._remove(waiter)
+            raise
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+
+class Scheduler:
+    """Named pools bounding downloads, ffmpeg encodes and metadata probes."""
+
+    def __init__(self, limits: dict[str, int], per_user: int, aging: float) -> None:
+        self._pools = {name: Pool(name, limit, per_user, aging) for name, limit in limits.items()}
+
+    def slot(self, pool: str, user_id: int, on_position=None, cost: float = 0.0):
+        return self._pools[pool].slot(user_id, on_position, cost)
+
+    def executor(self, pool: str) -> ThreadPoolExecutor:
+        """Thread pool sized to *pool*'s limit, for the blocking calls of its jobs."""
+        return self._pools[pool].executor
+
+
+scheduler = Scheduler(
+    {"download": DOWNLOAD_SLOTS, "cpu": FFMPEG_SLOTS, "probe": PROBE_SLOTS},
+    per_user=JOBS_PER_USER,
+    aging=SCHEDULER_AGING,
+)
@@ -0,0 +1,145 @@
+"""Saving finished files into the Yandex.Disk folder without blocking the event loop."""
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+_CHUNK = 8 * 1024 * 1024
+_PROGRESS_INTERVAL = 4.0
+# Linux ioctl sharing the source's extents with the destination (btrfs, XFS, ...)
+_FICLONE = 0x40049409
+
+# Disk-bound work must not take scheduler download/cpu slots
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="storage")
+
+_libc = None
+if sys.platform == "darwin":
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def unique_path(path: str) -> str:
+    """*path*, or "name (1).ext", "name (2).ext", ... if it is taken."""
+    base, ext = os.path.splitext(path)
+    candidate, n = path, 0
+    while os.path.lexists(candidate):
+        n += 1
+        candidate = f"{base} ({n}){ext}"
+    return candidate
+
+
+def _clonefile(src: str, dst: str) -> bool:
+    """macOS copy-on-write clone (APFS); False if unsupported here."""
+    if _libc is None:
+        return False
+    if _libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err == errno.EEXIST:
+        raise FileExistsError(err, os.strerror(err), dst)
+    return False
+
+
+def _copy_data(src_fd: int, dst_fd: int, total: int, progress) -> None:
+    """Copy src_fd into dst_fd: reflink, copy_file_range, sendfile, then plain reads."""
+    if sys.platform.startswith("linux"):
+        try:
+            fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+            return
+        except OSError:
+            pass
+
+    def read_write(n: int) -> int:
+        data = os.read(src_fd, n)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        return len(data)
+
+    done = 0
+    last_report = time.monotonic()
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append(lambda n: os.copy_file_range(src_fd, dst_fd, n))
+    if sys.platform.startswith("linux"):
+        methods.append(lambda n: os.sendfile(dst_fd, src_fd, None, n))
+    methods.append(read_write)
+
+    while done < total:
+        try:
+            copied = methods[0](min(_CHUNK, total - done))
+        except OSError as e:
+            # Cross-device, unsupported filesystem, ...: drop to the next method
+            if len(methods) == 1 or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            methods.pop(0)
+            continue
+        if not copied:
+            # copy_file_range returns 0 before EOF on some filesystems: try the next method
+            if len(methods) == 1:
+                raise OSError(errno.EIO, f"Copy stopped after {done} of {total} bytes")
+            methods.pop(0)
+            continue
+        done += copied
+        if progress and time.monotonic() - last_report >= _PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            progress(done, total)
+
+
+def save_file(src: str, dst: str, progress=None) -> str:
+    """Blocking: put a copy of *src* at *dst* (or the next free name); returns the path used.
+
+    A hardlink is tried first (same filesystem, no data copied), then a
+    copy-on-write clone, then a kernel-side copy. *progress(done, total)* is
+    called from this thread during a real copy.
+    """
+    while True:
+        dst = unique_path(dst)
+        try:
+            os.link(src, dst)
+            logger.info("Hardlinked %s -> %s", src, dst)
+            return dst
+        except FileExistsError:
+            continue
+        except OSError:
+            pass
+        try:
+            if _clonefile(src, dst):
+                logger.info("Cloned %s -> %s", src, dst)
+                return dst
+        except FileExistsError:
+            continue
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            continue
+        break
+
+    started = time.monotonic()
+    try:
+        try:
+            with open(src, "rb") as f:
+                _copy_data(f.fileno(), dst_fd, os.fstat(f.fileno()).st_size, progress)
+        finally:
+            os.close(dst_fd)
+        shutil.copystat(src, dst)
+    except BaseException:
+        os.remove(dst)
+        raise
+    logger.info("Copied %s -> %s in %.1f s", src, dst, time.monotonic() - started)
+    return dst
+
+
+async def save(src: str, dst: str, progress=None) -> str:
+    """save_file() on the storage threads; the event loop stays free."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_executor, partial(save_file, src, dst, progress))
@@ -0,0 +1,505 @@
+"""What a worker does with a queued job: download, compress or convert a file and deliver it to the chat.
+
+Jobs carry their whole state (URL, format, compression attempt, ...), so any
+worker can run them. The state a job returns is stored with it; the buttons
+it offers (compress, convert) name the job, and the bot queues the follow-up
+job from that state.
+"""
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.error import BadRequest
+
+from bot.config import LOCAL_API_URL, YANDEX_DISK_PATH
+from bot.downloader import (
+    audio_cost,
+    cached_info,
+    resolve_info,
+    video_cost,
+    download_video,
+    download_audio,
+    convert_to_mp3,
+    compress_file,
+    calculate_bitrate,
+)
+from bot.compressor import compress_to_target, plan_compression, plan_resolution, probe_media, scale_args
+from bot.ffmpeg import format_eta
+from bot.file_cache import download_cache
+from bot.file_index import file_index
+from bot.jobs import jobs
+from bot.progress import progress_channel
+from bot.scheduler import download_cost, encode_cost, scheduler
+from bot.storage import save, unique_path
+from bot.upload import UploadFile
+from bot.webdav import webdav
+
+logger = logging.getLogger(__name__)
+
+# Telegram send limits depend on whether we use the Local Bot API Server
+if LOCAL_API_URL:
+    SEND_LIMIT = 2000 * 1024 * 1024    # 2 GB with local server
+    TARGET_BYTES = 1999 * 1024 * 1024
+else:
+    SEND_LIMIT = 50 * 1024 * 1024      # 50 MB with official API
+    TARGET_BYTES = 49 * 1024 * 1024
+
+
+class JobContext:
+    """Where a running job reports to: the user's chat and the job's status message."""
+
+    __slots__ = ("bot", "job_id", "user_id", "chat_id", "message_id", "workdir")
+
+    def __init__(self, bot, job_id: int, user_id: int, chat_id: int, message_id: int) -> None:
+        self.bot = bot
+        self.job_id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.workdir: str | None = None
+
+    async def status(self, text: str, reply_markup=None) -> None:
+        """Replace the status message text; errors (message gone, not modified) are ignored."""
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.message_id, reply_markup=reply_markup,
+            )
+        except Exception:
+            pass
+
+    async def say(self, text: str, reply_markup=None) -> None:
+        await self.bot.send_message(self.chat_id, text, reply_markup=reply_markup)
+
+    def progress(self):
+        return progress_channel(self.bot, self.chat_id, self.message_id)
+
+
+def _queue_notifier(progress_cb) -> callable:
+    """Return a scheduler on_position callback that shows the queue position."""
+
+    def on_position(pos: int) -> None:
+        progress_cb(f"В очереди: {pos}. Начну, как только освободится место.")
+
+    return on_position
+
+
+def _yandex_dest(file_path: str, file_type: str) -> str:
+    """Return a free Yandex.Disk destination path for a file ("name (1).ext" if taken)."""
+    subdir = "Video" if file_type == "video" else "Audio"
+    dest_dir = os.path.join(YANDEX_DISK_PATH, subdir)
+    os.makedirs(dest_dir, exist_ok=True)
+    return unique_path(os.path.join(dest_dir, os.path.basename(file_path)))
+
+
+def derived_key(index_key, suffix: str) -> tuple[str, str] | None:
+    """Return the key of a variant derived from *index_key* (compressed, converted)."""
+    return (index_key[0], f"{index_key[1]}:{suffix}") if index_key else None
+
+
+async def send_indexed(bot, chat_id: int, index_key) -> bool:
+    """Re-send an already uploaded variant by file_id. Returns False if there is none.
+
+    Index calls run in a thread, like the job queue's: the file may be locked by another process.
+    """
+    if not index_key:
+        return False
+    hit = await asyncio.to_thread(file_index.get, *index_key)
+    if hit is None:
+        return False
+
+    kind, file_id = hit
+    send = {"audio": bot.send_audio, "video": bot.send_video}.get(kind, bot.send_document)
+    try:
+        await send(chat_id, file_id)
+    except BadRequest as e:
+        # Stale or foreign file_id — forget it and fall back to a normal download
+        logger.warning("Re-send of %s by file_id failed: %s", index_key, e)
+        await asyncio.to_thread(file_index.remove, *index_key)
+        return False
+    logger.info("Re-sent %s by file_id", index_key)
+    return True
+
+
+async def _send_document(ctx: JobContext, file_path: str, filename: str | None = None, index_key=None) -> None:
+    """Upload a file to the chat and remember its file_id under *index_key*.
+
+    The file is streamed from disk; upload progress goes to the status message.
+    """
+    if LOCAL_API_URL:
+        message = await ctx.bot.send_document(ctx.chat_id, document=Path(file_path))
+    else:
+        progress_cb = ctx.progress()
+
+        def on_upload_progress(done: int, total: int) -> None:
+            progress_cb(
+                f"Отправляю в Telegram... {done / total * 100:.0f}% "
+                f"({done / 1024 / 1024:.0f} / {total / 1024 / 1024:.0f} MB)"
+            )
+
+        try:
+            with UploadFile(file_path, progress=on_upload_progress) as f:
+                message = await ctx.bot.send_document(
+                    ctx.chat_id,
+                    document=InputFile(f, filename=filename or os.path.basename(file_path), read_file_handle=False),
+                )
+        finally:
+            progress_cb.close()
+
+    attachment = message.effective_attachment
+    if index_key and getattr(attachment, "file_id", None):
+        await asyncio.to_thread(
+            file_index.put,
+            *index_key,
+            kind=type(attachment).__name__.lower(),
+            file_id=attachment.file_id,
+            file_size=attachment.file_size,
+        )
+
+
+async def _fetch(ctx: JobContext, state: dict, progress_cb) -> str:
+    """Download the file *state* describes; a cache hit if this host still has it.
+
+    Release the returned path with download_cache.release() when done.
+    """
+    url = state["url"]
+    # Usually already resolved: by the prefetch on the bot, or by this worker's last job
+    info = await resolve_info(url)
+    if state["file_type"] == "video":
+        file_path, _ = await download_video(
+            url, state["height"], progress_callback=progress_cb, info=info, user_id=ctx.user_id,
+            format_spec=state.get("format_spec"),
+        )
+    else:
+        state["duration"] = info.get("duration")
+        file_path, _ = await download_audio(
+            url, state["bitrate"], progress_callback=progress_cb, info=info, user_id=ctx.user_id,
+        )
+    return file_path
+
+
+async def _already_sent(ctx: JobContext, index_key) -> bool:
+    """Re-send by file_id a result uploaded before this job was interrupted (or by another job meanwhile)."""
+    if await send_indexed(ctx.bot, ctx.chat_id, index_key):
+        await ctx.status("Отправлено.")
+        return True
+    return False
+
+
+async def run_download(ctx: JobContext, state: dict) -> dict | None:
+    """Download a video or audio file and deliver it."""
+    if await _already_sent(ctx, state.get("index_key")):
+        return None
+    if state["file_type"] == "video":
+        await ctx.status("Скачиваю видео...")
+    elif state["bitrate"] == "original":
+        await ctx.status("Скачиваю аудио (оригинал)...")
+    elif state["bitrate"] == "m4a":
+        await ctx.status("Скачиваю аудио (M4A/AAC)...")
+    else:
+        await ctx.status(f"Скачиваю аудио (MP3 {state['bitrate']} kbps)...")
+
+    progress_cb = ctx.progress()
+    try:
+        file_path = await _fetch(ctx, state, progress_cb)
+    except Exception as e:
+        logger.error("Download of %s failed: %s", state["url"], e)
+        await ctx.status(f"Не удалось скачать: {e}")
+        return None
+    finally:
+        progress_cb.close()
+
+    try:
+        return await _deliver(ctx, state, file_path)
+    except Exception as e:
+        logger.error("Delivery of %s failed: %s", file_path, e)
+        await ctx.status(f"Не удалось отправить файл: {e}")
+        return None
+    finally:
+        download_cache.release(file_path)
+
+
+async def _deliver(ctx: JobContext, state: dict, file_path: str) -> dict | None:
+    """Send file to Telegram if ≤ send limit, otherwise save to Yandex.Disk and offer compression.
+
+    Returns the state for the offered follow-up (convert or compress), if any.
+    """
+    size = os.path.getsize(file_path)
+    size_mb = size / (1024 * 1024)
+
+    if size <= SEND_LIMIT:
+        await ctx.status(f"Отправляю в Telegram ({size_mb:.1f} MB)...")
+        await _send_document(ctx, file_path, index_key=state.get("index_key"))
+
+        # If we just sent a non-mp3 audio file, offer conversion
+        ext = os.path.splitext(file_path)[1].lower()
+        if state["file_type"] == "audio" and ext != ".mp3":
+            keyboard = InlineKeyboardMarkup([
+                [
+                    InlineKeyboardButton("Да, в MP3", callback_data=f"convert:yes:{ctx.job_id}"),
+                    InlineKeyboardButton("Нет", callback_data=f"convert:no:{ctx.job_id}"),
+                ]
+            ])
+            await ctx.say("Сконвертировать в MP3 без потери качества?", reply_markup=keyboard)
+            return state
+        await ctx.status("Отправлено.")
+        return None
+
+    # File is too large for Telegram — save original to Yandex.Disk
+    await ctx.status(f"Файл {size_mb:.1f} MB — сохраняю на Яндекс.Диск...")
+    file_type = state["file_type"]
+
+    def on_copy_progress(done: int, total: int) -> None:
+        copy_cb(f"Сохраняю на Яндекс.Диск... {done / total * 100:.0f}% ({done / 1024 / 1024:.0f} / {size_mb:.0f} MB)")
+
+    copy_cb = ctx.progress()
+    try:
+        if webdav is not None:
+            subdir = "Video" if file_type == "video" else "Audio"
+            dest_path = await webdav.upload(file_path, subdir, progress=on_copy_progress)
+        else:
+            dest_path = await save(file_path, _yandex_dest(file_path, file_type), progress=on_copy_progress)
+        logger.info("Saved to Yandex.Disk: %s", dest_path)
+    except Exception as e:
+        logger.error("Failed to copy to Yandex.Disk: %s", e)
+        await ctx.say(f"Не удалось сохранить на Яндекс.Диск: {e}")
+        return None
+    finally:
+        copy_cb.close()
+
+    # Reset compression state for this file
+    state["compress_attempt"] = 1
+    state.pop("last_video_kbps", None)
+    state.pop("last_audio_kbps", None)
+    state.pop("compress_plan", None)
+
+    # Predict the compressed size and encode time from a few sample encodes
+    await ctx.status(f"Файл {size_mb:.1f} MB — оцениваю сжатие...")
+    prediction = ""
+    try:
+        async with scheduler.slot("cpu", ctx.user_id, cost=encode_cost(60, is_audio=False)):
+            plan = await plan_compression(file_path, TARGET_BYTES, workdir=ctx.workdir)
+        state["compress_plan"] = plan
+        prediction = f"\nПрогноз: ~{plan['predicted_bytes'] / 1024 / 1024:.0f} MB"
+        if plan.get("scale"):
+            prediction += f", {plan['short_side']}p"
+        if plan["predicted_seconds"]:
+            prediction += f", сжатие займёт ~{format_eta(plan['predicted_seconds'])}"
+    except Exception as e:
+        logger.warning("Compression planning failed for %s: %s", file_path, e)
+
+    keyboard = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("Да, сжать", callback_data=f"compress:yes:{ctx.job_id}"),
+            InlineKeyboardButton("Нет, не надо", callback_data=f"compress:no:{ctx.job_id}"),
+        ]
+    ])
+    await ctx.say(
+        f"Файл {size_mb:.1f} MB. Оригинал сохранён в Яндекс.Диск.\n"
+        f"Сжать до {TARGET_BYTES // (1024 * 1024)} MB и отправить в Telegram?{prediction}",
+        reply_markup=keyboard,
+    )
+    return state
+
+
+async def run_compress(ctx: JobContext, state: dict) -> dict | None:
+    """One round of the iterative compression loop; offers another, stronger one if still too large."""
+    if await _already_sent(ctx, derived_key(state.get("index_key"), "compressed")):
+        return None
+    attempt = state.get("compress_attempt", 1)
+    is_audio = state["file_type"] == "audio"
+    await ctx.status(f"Сжимаю (попытка {attempt})...")
+
+    progress_cb = ctx.progress()
+    try:
+        file_path = await _fetch(ctx, state, progress_cb)
+    except Exception as e:
+        progress_cb.close()
+        logger.error("Download of %s failed: %s", state["url"], e)
+        await ctx.status(f"Не удалось скачать: {e}")
+        return None
+
+    try:
+        return await _compress(ctx, state, file_path, attempt, is_audio, progress_cb)
+    finally:
+        progress_cb.close()
+        download_cache.release(file_path)
+
+
+async def _compress(
+    ctx: JobContext, state: dict, file_path: str, attempt: int, is_audio: bool, progress_cb,
+) -> dict | None:
+    plan = state.get("compress_plan") if attempt == 1 else None
+    try:
+        media = plan["media"] if plan else await probe_media(file_path)
+    except Exception as e:
+        await ctx.status(f"Не удалось определить длительность: {e}")
+        return None
+    duration = media["duration"]
+
+    # First attempt is a size-targeted two-pass encode; later ones are only a safety net
+    if attempt > 1:
+        video_kbps, audio_kbps = calculate_bitrate(
+            duration=duration,
+            target_bytes=TARGET_BYTES,
+            is_audio=is_audio,
+            attempt=attempt,
+            prev_video_kbps=state.get("last_video_kbps", 0),
+            prev_audio_kbps=state.get("last_audio_kbps", 128),
+        )
+    passes = 2 if attempt == 1 and not is_audio else 1
+    cost = encode_cost(duration, is_audio) * passes
+    if plan and plan["predicted_seconds"]:
+        cost = plan["predicted_seconds"]
+
+    compressed_path = None
+    try:
+        async with scheduler.slot(
+            "cpu", ctx.user_id,
+            on_position=_queue_notifier(progress_cb),
+            cost=cost,
+        ):
+            progress_cb(f"Сжимаю (попытка {attempt})...")
+            if attempt == 1:
+                compressed_path, result_size, video_kbps, audio_kbps = await compress_to_target(
+                    file_path, TARGET_BYTES, plan=plan, progress_callback=progress_cb, workdir=ctx.workdir,
+                )
+            else:
+                short_side, fps = plan_resolution(media["width"], media["height"], media["fps"], video_kbps)
+                compressed_path, result_size = await compress_file(
+                    file_path, video_kbps, audio_kbps, duration=duration,
+                    scale=scale_args(media["width"], media["height"], short_side, fps),
+                    progress_callback=progress_cb, workdir=ctx.workdir,
+                )
+    except Exception as e:
+        logger.error("compress_file failed: %s", e)
+        await ctx.status(f"Ошибка сжатия: {e}")
+        return None
+    finally:
+        progress_cb.close()
+
+    result_mb = result_size / (1024 * 1024)
+
+    if result_size <= TARGET_BYTES:
+        # Success — send to Telegram
+        try:
+            await _send_document(
+                ctx,
+                compressed_path,
+                filename=os.path.basename(file_path),
+                index_key=derived_key(state.get("index_key"), "compressed"),
+            )
+            await ctx.status("Сжато и отправлено в Telegram.")
+        except Exception as e:
+            logger.error("send compressed failed: %s", e)
+            await ctx.status(f"Не удалось отправить: {e}")
+        finally:
+            if compressed_path and os.path.exists(compressed_path):
+                os.remove(compressed_path)
+        return None
+
+    # Still too large — clean up this attempt's file and ask again
+    if compressed_path and os.path.exists(compressed_path):
+        os.remove(compressed_path)
+
+    # Save bitrates for next attempt
+    state["last_video_kbps"] = video_kbps
+    state["last_audio_kbps"] = audio_kbps
+    state["compress_attempt"] = attempt + 1
+
+    keyboard = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("Да, ещё сжать", callback_data=f"compress:yes:{ctx.job_id}"),
+            InlineKeyboardButton("Нет, хватит", callback_data=f"compress:no:{ctx.job_id}"),
+        ]
+    ])
+    await ctx.status(
+        f"Сжатый файл {result_mb:.1f} MB — всё ещё большой. Попробовать агрессивнее?",
+        reply_markup=keyboard,
+    )
+    return state
+
+
+async def run_convert(ctx: JobContext, state: dict) -> None:
+    """Convert a delivered non-mp3 audio file to MP3 and send that too."""
+    if await _already_sent(ctx, derived_key(state.get("index_key"), "mp3")):
+        return
+    await ctx.status("Конвертирую в MP3...")
+
+    progress_cb = ctx.progress()
+    mp3_path = None
+    try:
+        source = await _fetch(ctx, state, progress_cb)
+        try:
+            async with scheduler.slot(
+                "cpu", ctx.user_id,
+                on_position=_queue_notifier(progress_cb),
+                cost=encode_cost(state.get("duration"), is_audio=True),
+            ):
+                progress_cb("Конвертирую в MP3...")
+                mp3_path = await convert_to_mp3(
+                    source, progress_callback=progress_cb, duration=state.get("duration"), workdir=ctx.workdir,
+                )
+        finally:
+            download_cache.release(source)
+    except Exception as e:
+        logger.error("convert_to_mp3 failed: %s", e)
+        await ctx.status(f"Ошибка конвертации: {e}")
+        return
+    finally:
+        progress_cb.close()
+
+    mp3_mb = os.path.getsize(mp3_path) / (1024 * 1024)
+    await ctx.status(f"Отправляю MP3 ({mp3_mb:.1f} MB)...")
+
+    try:
+        await _send_document(ctx, mp3_path, index_key=derived_key(state.get("index_key"), "mp3"))
+        await ctx.status("Отправлено.")
+    except Exception as e:
+        logger.error("send mp3 failed: %s", e)
+        await ctx.status(f"Не удалось отправить: {e}")
+    finally:
+        if os.path.exists(mp3_path):
+            os.remove(mp3_path)
+
+
+_RUNNERS = {
+    "video": run_download,
+    "audio": run_download,
+    "compress": run_compress,
+    "convert": run_convert,
+}
+
+
+def job_cost(kind: str, state: dict) -> float:
+    """Estimated seconds a queued *kind* job over *state* will take; ranks it in the queue like the scheduler does."""
+    if kind in ("video", "audio"):
+        # Usually cached by the time a format is picked; never wait for the extraction here
+        info = cached_info(state["url"])
+        if info is None:
+            return download_cost(None, None)
+        return video_cost(info, state["height"]) if kind == "video" else audio_cost(info, state["bitrate"])
+    is_audio = state.get("file_type") == "audio"
+    if kind == "convert":
+        return encode_cost(state.get("duration"), is_audio=True)
+    attempt = state.get("compress_attempt", 1)
+    plan = state.get("compress_plan") if attempt == 1 else None
+    if plan and plan["predicted_seconds"]:
+        return plan["predicted_seconds"]
+    duration = plan["media"]["duration"] if plan else state.get("duration")
+    passes = 2 if attempt == 1 and not is_audio else 1
+    return encode_cost(duration, is_audio) * passes
+
+
+async def run_job(bot, job_id: int, user_id: int, kind: str, params: dict) -> dict | None:
+    """Run one queued job as a cancellable job of its user; returns the state to store with it."""
+    ctx = JobContext(bot, job_id, user_id, params["chat_id"], params["message_id"])
+    result = None
+    async with jobs.run(user_id, kind) as job:
+        ctx.workdir = job.workdir
+        result = await _RUNNERS[kind](ctx, params["state"])
+    if job.cancelled:
+        await ctx.status("Операция отменена.")
+        return None
+    return result
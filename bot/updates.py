@@ -0,0 +1,75 @@
+"""Concurrent update processing that keeps each user's updates in order."""
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Updates that may be queued at once; the real limit on running handlers is our own
+_MAX_PENDING = 4096
+
+
+def _owner(update: object) -> int | None:
+    """Whose updates must not overlap: the user (owner of user_data), else the chat."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+def _is_cancel(update: object) -> bool:
+    message = update.effective_message if isinstance(update, Update) else None
+    if message is None or not message.text:
+        return False
+    return message.text.split()[0].split("@")[0] == "/cancel"
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Runs different users' updates in parallel and each user's one at a time, in arrival order.
+
+    Serializing per user means a user's handlers never touch the same
+    user_data at once. At most ``max_running`` handlers run overall; an update
+    waiting behind its own user's earlier one does not take a place. /cancel
+    skips both waits, since it has to reach a user whose earlier update is
+    still running.
+    """
+
+    def __init__(self, max_running: int) -> None:
+        super().__init__(_MAX_PENDING)
+        self._running = asyncio.Semaphore(max(1, max_running))
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._queued: dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        if _is_cancel(update):
+            await coroutine
+            return
+
+        owner = _owner(update)
+        if owner is None:
+            async with self._running:
+                await coroutine
+            return
+
+        lock = self._locks.setdefault(owner, asyncio.Lock())
+        self._queued[owner] = self._queued.get(owner, 0) + 1
+        try:
+            # asyncio.Lock wakes waiters first-come first-served, which keeps arrival order
+            async with lock, self._running:
+                await coroutine
+        finally:
+            self._queued[owner] -= 1
+            if not self._queued[owner]:
+                del self._queued[owner]
+                del self._locks[owner]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
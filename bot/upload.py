@@ -0,0 +1,149 @@
+"""Bot API transport: media sends get their own HTTP pool and stream files from disk."""
+import asyncio
+import io
+import os
+import uuid
+
+import httpx
+from telegram.error import NetworkError, TimedOut
+from telegram.request import HTTPXRequest, RequestData
+
+from bot.config import UPLOAD_CONNECTIONS, UPLOAD_TIMEOUT
+
+_READ_SIZE = 1024 * 1024
+
+# Sends that may carry a file (or make the local server copy one); everything
+# else is a small JSON call
+MEDIA_ENDPOINTS = {
+    "sendDocument", "sendVideo", "sendAudio", "sendPhoto", "sendVoice", "sendMediaGroup",
+}
+
+
+class UploadFile(io.FileIO):
+    """A file opened for upload. *progress(done, total)* is called on the event loop as it is sent.
+
+    Pass it as ``InputFile(f, read_file_handle=False)`` so python-telegram-bot
+    keeps the handle instead of reading the whole file into memory.
+    """
+
+    def __init__(self, path: str, progress=None) -> None:
+        super().__init__(path, "rb")
+        self.progress = progress
+
+
+def _quote(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+def _multipart(request_data: RequestData) -> tuple[str, int, object]:
+    """(content type, length, async body) of a multipart/form-data request.
+
+    Text fields are encoded up front; file handles are read in chunks off the
+    event loop while the body is sent, so memory use does not grow with the file.
+    """
+    boundary = uuid.uuid4().hex
+    parts: list[tuple[bytes, object, int]] = []
+    for name, value in request_data.json_parameters.items():
+        head = f'--{boundary}\r\nContent-Disposition: form-data; name="{_quote(name)}"\r\n\r\n'.encode()
+        data = value.encode()
+        parts.append((head, data, len(data)))
+    for name, (filename, content, mimetype) in request_data.multipart_data.items():
+        head = (
+            f"--{boundary}\r\nContent-Disposition: form-data; "
+            f'name="{_quote(name)}"; filename="{_quote(filename)}"\r\n'
+            f"Content-Type: {mimetype}\r\n\r\n"
+        ).encode()
+        size = len(content) if isinstance(content, bytes) else os.fstat(content.fileno()).st_size
+        parts.append((head, content, size))
+    tail = f"--{boundary}--\r\n".encode()
+
+    length = len(tail) + sum(len(head) + size + 2 for head, _, size in parts)
+
+    async def body():
+        for head, content, size in parts:
+            yield head
+            if isinstance(content, bytes):
+                yield content
+            else:
+                # Rewind: the rate limiter may retry the request after a flood wait
+                content.seek(0)
+                progress = getattr(content, "progress", None)
+                done = 0
+                while done < size:
+                    data = await asyncio.to_thread(content.read, min(_READ_SIZE, size - done))
+                    if not data:
+                        raise NetworkError(f"{content.name} shrank during upload")
+                    done += len(data)
+                    if progress:
+                        progress(done, size)
+                    yield data
+            yield b"\r\n"
+        yield tail
+
+    return f"multipart/form-data; boundary={boundary}", length, body()
+
+
+class BotRequest(HTTPXRequest):
+    """HTTPXRequest with a second, separately sized pool for media sends.
+
+    Small API calls keep short timeouts and never wait behind an upload; media
+    sends use ``upload_pool_size`` connections with long timeouts, and files
+    in them are streamed from disk instead of being buffered.
+    """
+
+    def __init__(self, upload_pool_size: int, upload_timeout: float, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self._upload_kwargs = {
+            "timeout": httpx.Timeout(connect=30.0, read=upload_timeout, write=upload_timeout, pool=None),
+            "limits": httpx.Limits(max_connections=upload_pool_size),
+        }
+        self._uploads = httpx.AsyncClient(**self._upload_kwargs)
+
+    async def initialize(self) -> None:
+        await super().initialize()
+        if self._uploads.is_closed:
+            self._uploads = httpx.AsyncClient(**self._upload_kwargs)
+
+    async def shutdown(self) -> None:
+        await super().shutdown()
+        if not self._uploads.is_closed:
+            await self._uploads.aclose()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=HTTPXRequest.DEFAULT_NONE,
+                         write_timeout=HTTPXRequest.DEFAULT_NONE, connect_timeout=HTTPXRequest.DEFAULT_NONE,
+                         pool_timeout=HTTPXRequest.DEFAULT_NONE) -> tuple[int, bytes]:
+        if url.rsplit("/", 1)[-1] not in MEDIA_ENDPOINTS:
+            return await super().do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout,
+            )
+
+        headers = {"User-Agent": self.USER_AGENT}
+        if request_data is not None and request_data.contains_files:
+            content_type, length, body = _multipart(request_data)
+            headers.update({"Content-Type": content_type, "Content-Length": str(length)})
+            kwargs = {"content": body}
+        else:
+            kwargs = {"data": request_data.json_parameters if request_data else None}
+
+        # Per-call timeouts are meant for small requests; media sends keep the pool's own
+        try:
+            response = await self._uploads.request(method=method, url=url, headers=headers, **kwargs)
+        except httpx.TimeoutException as err:
+            raise TimedOut from err
+        except httpx.HTTPError as err:
+            raise NetworkError(f"httpx.{err.__class__.__name__}: {err}") from err
+        return response.status_code, response.content
+
+
+def bot_request() -> BotRequest:
+    """The configured request object for Bot API calls (the bot and the workers use the same)."""
+    # Short API calls get their own pool; file sends use the separate upload pool
+    return BotRequest(
+        upload_pool_size=UPLOAD_CONNECTIONS,
+        upload_timeout=UPLOAD_TIMEOUT,
+        connection_pool_size=16,
+        read_timeout=15,
+        write_timeout=15,
+        connect_timeout=10,
+        pool_timeout=5,
+    )
@@ -0,0 +1,34 @@
+import re
+from urllib.parse import parse_qs, urlparse
+
+_VIDEO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+_PATH_PREFIXES = ("/shorts/", "/embed/", "/live/", "/v/")
+
+
+def extract_video_id(url: str) -> str | None:
+    """Return the 11-character YouTube video ID, ignoring tracking params (si=, t=, ...)."""
+    if not url.startswith("http"):
+        url = "https://" + url
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+
+    candidate = None
+    if host == "youtu.be":
+        candidate = parsed.path.lstrip("/").split("/", 1)[0]
+    elif host.endswith("youtube.com"):
+        if parsed.path == "/watch":
+            candidate = (parse_qs(parsed.query).get("v") or [""])[0]
+        else:
+            for prefix in _PATH_PREFIXES:
+                if parsed.path.startswith(prefix):
+                    candidate = parsed.path[len(prefix):].split("/", 1)[0]
+                    break
+
+    if candidate and _VIDEO_ID_RE.match(candidate):
+        return candidate
+    return None
+
+
+def canonical_url(video_id: str) -> str:
+    """Return the canonical watch URL for a video ID."""
+    return f"https://www.youtube.com/watch?v={video_id}"
@@ -0,0 +1,240 @@
+"""Direct WebDAV upload of large files to Yandex.Disk, instead of a locally synced folder."""
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import time
+from urllib.parse import quote
+
+import httpx
+
+from bot.config import (
+    WEBDAV_CHUNK_SIZE,
+    WEBDAV_PARALLEL,
+    WEBDAV_PASSWORD,
+    WEBDAV_ROOT,
+    WEBDAV_URL,
+    WEBDAV_USER,
+)
+
+logger = logging.getLogger(__name__)
+
+_READ_SIZE = 1024 * 1024
+_RETRIES = 5
+_PROGRESS_INTERVAL = 4.0
+
+
+class _RangeNotSupported(Exception):
+    """The server rejected or ignored a Content-Range PUT."""
+
+
+class WebDavUploader:
+    """Streams files to a WebDAV server over one pooled HTTP client.
+
+    An upload goes to "<name>.<token>.part" in ``chunk_size`` ranges (PUT with
+    Content-Range), and after every range the server-side size is checked, so
+    an interrupted upload continues from what the server already has. The
+    token is derived from the source file (host, path, size, mtime), so this
+    also holds for an upload cut off by a restart. Servers
+    that reject or ignore ranged PUTs get one streamed PUT instead, restarted
+    from zero on failure. The finished file is MOVEd to a free final name.
+    At most ``parallel`` uploads run at once.
+    """
+
+    def __init__(
+        self, base_url: str, user: str, password: str, root: str, parallel: int, chunk_size: int,
+    ) -> None:
+        self._base = base_url
+        self._root = "/" + root.strip("/") if root.strip("/") else ""
+        self._auth = (user, password) if user else None
+        self._chunk_size = chunk_size
+        self._parallel = max(1, parallel)
+        self._semaphore = asyncio.Semaphore(self._parallel)
+        self._client: httpx.AsyncClient | None = None
+        self._dirs: set[str] = set()
+        # Part name -> [lock, uploads using it]: uploads of the same source take turns on its part
+        self._parts: dict[str, list] = {}
+        # Learned from the first ranged PUT; None until then
+        self._ranged: bool | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                auth=self._auth,
+                timeout=httpx.Timeout(120.0, connect=15.0),
+                limits=httpx.Limits(max_connections=self._parallel * 2, max_keepalive_connections=self._parallel),
+            )
+        return self._client
+
+    def _url(self, path: str) -> str:
+        return self._base + quote(path)
+
+    async def _ensure_dir(self, path: str) -> None:
+        current = ""
+        for part in path.strip("/").split("/"):
+            current += "/" + part
+            if current in self._dirs:
+                continue
+            response = await self.client.request("MKCOL", self._url(current))
+            # 405: already exists
+            if response.status_code != 405 and not response.is_success:
+                response.raise_for_status()
+            self._dirs.add(current)
+
+    async def _size(self, path: str) -> int | None:
+        """Size of a remote file, or None if it does not exist."""
+        response = await self.client.head(self._url(path))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return int(response.headers.get("Content-Length", 0))
+
+    async def _free_name(self, directory: str, name: str) -> str:
+        base, ext = os.path.splitext(name)
+        candidate, n = f"{directory}/{name}", 0
+        while await self._size(candidate) is not None:
+            n += 1
+            candidate = f"{directory}/{base} ({n}){ext}"
+        return candidate
+
+    @staticmethod
+    def _part_token(file_path: str) -> str:
+        """Token naming the part of *file_path*: the same for the same file across runs."""
+        st = os.stat(file_path)
+        raw = f"{socket.gethostname()}:{os.path.abspath(file_path)}:{st.st_size}:{st.st_mtime_ns}"
+        return hashlib.sha256(raw.encode()).hexdigest()[:12]
+
+    @staticmethod
+    async def _read(file_path: str, start: int, length: int, on_bytes):
+        """Async body: *length* bytes of *file_path* from *start*, read off the event loop."""
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            while length > 0:
+                data = await asyncio.to_thread(f.read, min(_READ_SIZE, length))
+                if not data:
+                    break
+                length -= len(data)
+                on_bytes(len(data))
+                yield data
+
+    async def _put(self, path: str, file_path: str, start: int, end: int, total: int, on_bytes) -> httpx.Response:
+        headers = {"Content-Length": str(end - start + 1)}
+        if end - start + 1 != total:
+            headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+        return await self.client.put(
+            self._url(path), content=self._read(file_path, start, end - start + 1, on_bytes), headers=headers,
+        )
+
+    async def _upload_ranged(self, file_path: str, part: str, total: int, on_bytes, sent: list[int]) -> None:
+        offset = await self._size(part) or 0
+        if offset > total:
+            await self.client.delete(self._url(part))
+            offset = 0
+        if offset:
+            logger.info("Resuming WebDAV upload of %s at %d / %d bytes", part, offset, total)
+        sent[0] = offset
+        while offset < total:
+            end = min(offset + self._chunk_size, total) - 1
+            response = await self._put(part, file_path, offset, end, total, on_bytes)
+            if response.status_code in (400, 405, 416, 501):
+                raise _RangeNotSupported(f"HTTP {response.status_code}")
+            response.raise_for_status()
+            # A server that ignores Content-Range stores only the last chunk
+            if await self._size(part) != end + 1:
+                raise _RangeNotSupported("Content-Range ignored")
+            offset = end + 1
+            self._ranged = True
+
+    async def _upload_whole(self, file_path: str, part: str, total: int, on_bytes, sent: list[int]) -> None:
+        sent[0] = 0
+        response = await self._put(part, file_path, 0, total - 1, total, on_bytes)
+        response.raise_for_status()
+
+    async def upload(self, file_path: str, subdir: str, progress=None) -> str:
+        """Upload *file_path* into <root>/<subdir>; returns the remote path.
+
+        *progress(done, total)* is called on the event loop while bytes go out.
+        A part left by a cancelled upload of the same file (a restart) is resumed.
+        """
+        name = os.path.basename(file_path)
+        directory = f"{self._root}/{subdir}"
+        part = f"{directory}/{name}.{self._part_token(file_path)}.part"
+        turn = self._parts.setdefault(part, [asyncio.Lock(), 0])
+        turn[1] += 1
+        try:
+            async with turn[0], self._semaphore:
+                return await self._upload(file_path, directory, name, part, progress)
+        finally:
+            turn[1] -= 1
+            if not turn[1]:
+                del self._parts[part]
+
+    async def _upload(self, file_path: str, directory: str, name: str, part: str, progress) -> str:
+        total = os.path.getsize(file_path)
+        await self._ensure_dir(directory)
+
+        sent = [0]
+        last_report = [time.monotonic()]
+
+        def on_bytes(n: int) -> None:
+            sent[0] += n
+            if progress and time.monotonic() - last_report[0] >= _PROGRESS_INTERVAL:
+                last_report[0] = time.monotonic()
+                progress(sent[0], total)
+
+        started = time.monotonic()
+        failures = 0
+        while True:
+            try:
+                if self._ranged is not False and total > self._chunk_size:
+                    try:
+                        await self._upload_ranged(file_path, part, total, on_bytes, sent)
+                        break
+                    except _RangeNotSupported as e:
+                        logger.info("WebDAV server has no ranged PUT (%s), streaming whole files", e)
+                        self._ranged = False
+                await self._upload_whole(file_path, part, total, on_bytes, sent)
+                break
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                failures += 1
+                retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code >= 500
+                if not retryable or failures > _RETRIES:
+                    await self._discard(part)
+                    raise
+                logger.warning("WebDAV upload of %s interrupted (%s), retry %d", name, e, failures)
+                await asyncio.sleep(min(2 ** failures, 30))
+
+        while True:
+            final = await self._free_name(directory, name)
+            response = await self.client.request(
+                "MOVE", self._url(part), headers={"Destination": self._url(final), "Overwrite": "F"},
+            )
+            # 412: another upload took the name in the meantime
+            if response.status_code != 412:
+                break
+        response.raise_for_status()
+        logger.info(
+            "Uploaded %s to WebDAV %s (%.1f MB in %.1f s)",
+            file_path, final, total / 1024 / 1024, time.monotonic() - started,
+        )
+        return final
+
+    async def _discard(self, part: str) -> None:
+        try:
+            await self.client.delete(self._url(part))
+        except httpx.HTTPError:
+            pass
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+webdav = (
+    WebDavUploader(WEBDAV_URL, WEBDAV_USER, WEBDAV_PASSWORD, WEBDAV_ROOT, WEBDAV_PARALLEL, WEBDAV_CHUNK_SIZE)
+    if WEBDAV_URL
+    else None
+)
@@ -0,0 +1,289 @@
+"""Job queue between the bot, which takes requests, and the workers that download, encode and deliver."""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Collection
+
+from bot.config import JOB_QUEUE_DB, SCHEDULER_AGING
+
+logger = logging.getLogger(__name__)
+
+# A running job whose worker has not checked in for this long is given to another worker;
+# an interrupted one waits as long for its own worker, which has its partial download
+_STALE_AFTER = 60.0
+# ...at most this many times; a job that keeps killing its workers is given up
+_MAX_ATTEMPTS = 3
+# Finished jobs are kept so their follow-up buttons (compress, convert) keep working
+_RETENTION = 7 * 86400
+
+
+class WorkQueue(ABC):
+    """What the bot and the workers need from a queue backend.
+
+    A job is a JSON-serializable descriptor with everything a worker on any
+    host needs to run it (URL, format, chat and status message). Workers
+    claim queued jobs, check in regularly while running them and finish them
+    with a result: the state follow-up jobs of the same file start from.
+    """
+
+    @abstractmethod
+    def put(self, user_id: int, kind: str, params: dict, cost: float = 0.0) -> int:
+        """Queue a job expected to take *cost* seconds; returns its ID."""
+
+    @abstractmethod
+    def ahead(self, cost: float = 0.0) -> int:
+        """How many queued jobs would be claimed before one put now with *cost*."""
+
+    @abstractmethod
+    def claim(self, worker: str, skip_users: Collection[int] = ()) -> tuple[int, int, str, dict] | None:
+        """Take the next job for *worker*, none of *skip_users*: (job ID, user ID, kind, params), or None.
+
+        The worker's own interrupted jobs come first, then the others in the
+        scheduler's order: shortest expected job first, with waiting time
+        credited at SCHEDULER_AGING.
+        """
+
+    @abstractmethod
+    def heartbeat(self, worker: str, job_ids: list[int]) -> None:
+        """Check in for running jobs, so no other worker takes them over."""
+
+    @abstractmethod
+    def stopped(self, worker: str, job_ids: list[int]) -> dict[int, str]:
+        """Of *worker*'s running jobs, those it must stop (cancelled, taken over), with their status."""
+
+    @abstractmethod
+    def finish(self, job_id: int, status: str, result: dict | None = None) -> None:
+        """Record the outcome ("done" or "failed") of a job that is still running."""
+
+    @abstractmethod
+    def requeue(self, job_id: int, worker: str) -> None:
+        """Hand a job *worker* is giving up (shutting down) back to the queue; it gets it back first."""
+
+    @abstractmethod
+    def recover(self, worker: str) -> int:
+        """Queue again the jobs a previous run of *worker* left running (it crashed); returns how many."""
+
+    @abstractmethod
+    def announce_bot(self) -> None:
+        """Record that the bot fills this queue."""
+
+    @abstractmethod
+    def bot_seen(self) -> bool:
+        """Whether a bot has announced itself here; a worker on any other queue would wait forever."""
+
+    @abstractmethod
+    def get(self, job_id: int) -> dict | None:
+        """The job's user_id, kind, status, params and result, or None if unknown."""
+
+    @abstractmethod
+    def cancel_user(self, user_id: int) -> tuple[int, list[dict]]:
+        """Cancel every unfinished job of *user_id*.
+
+        Returns how many there were and the params of those no worker had
+        started yet; running ones are stopped by their worker.
+        """
+
+
+class SqliteWorkQueue(WorkQueue):
+    """WorkQueue in a sqlite file; the bot and every worker open the same file.
+
+    Claims run in an immediate transaction, so two workers never take the
+    same job. Workers on other hosts need the file on storage with working
+    locks. A job's score is its cost plus *aging* times its creation time:
+    ordering by it is ordering by cost minus the aging credit of its wait,
+    without updating rows as they wait.
+    """
+
+    def __init__(self, db_path: str, aging: float = SCHEDULER_AGING) -> None:
+        self._aging = aging
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " user_id INTEGER NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " params TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " worker TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " heartbeat REAL,"
+            " result TEXT,"
+            " created REAL NOT NULL,"
+            " updated REAL NOT NULL,"
+            " score REAL NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if "score" not in columns:
+            # Queue files from before scores: their jobs rank by age alone
+            self._db.execute("ALTER TABLE jobs ADD COLUMN score REAL NOT NULL DEFAULT 0")
+            self._db.execute("UPDATE jobs SET score = ? * created", (aging,))
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_score ON jobs (status, score)")
+
+    def put(self, user_id: int, kind: str, params: dict, cost: float = 0.0) -> int:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND updated < ?",
+                (now - _RETENTION,),
+            )
+            cursor = self._db.execute(
+                "INSERT INTO jobs (user_id, kind, params, status, created, updated, score)"
+                " VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (user_id, kind, json.dumps(params), now, now, cost + self._aging * now),
+            )
+        return cursor.lastrowid
+
+    def ahead(self, cost: float = 0.0) -> int:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND score <= ?",
+                (cost + self._aging * time.time(),),
+            ).fetchone()
+        return row[0]
+
+    def claim(self, worker: str, skip_users: Collection[int] = ()) -> tuple[int, int, str, dict] | None:
+        now = time.time()
+        skip_users = list(skip_users)
+        skip = f" AND user_id NOT IN ({','.join('?' * len(skip_users))})" if skip_users else ""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    # Interrupted jobs go back to the worker that has their partial files
+                    row = self._db.execute(
+                        "SELECT id, user_id, kind, params, status, attempts FROM jobs"
+                        " WHERE ((status = 'queued' AND (worker IS NULL OR worker = ? OR updated < ?))"
+                        f" OR (status = 'running' AND heartbeat < ?)){skip}"
+                        " ORDER BY worker IS ? DESC, score, id LIMIT 1",
+                        (worker, now - _STALE_AFTER, now - _STALE_AFTER, *skip_users, worker),
+                    ).fetchone()
+                    if row is None:
+                        break
+                    job_id, user_id, kind, params, status, attempts = row
+                    if status == "running":
+                        logger.warning("Job %d (%s) lost its worker, restarting it", job_id, kind)
+                    if attempts >= _MAX_ATTEMPTS:
+                        logger.error("Job %d (%s) given up after %d attempts", job_id, kind, attempts)
+                        self._db.execute(
+                            "UPDATE jobs SET status = 'failed', updated = ? WHERE id = ?", (now, job_id),
+                        )
+                        continue
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1,"
+                        " heartbeat = ?, updated = ? WHERE id = ?",
+                        (worker, now, now, job_id),
+                    )
+                    break
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return job_id, user_id, kind, json.loads(params)
+
+    def heartbeat(self, worker: str, job_ids: list[int]) -> None:
+        if not job_ids:
+            return
+        marks = ",".join("?" * len(job_ids))
+        with self._lock:
+            self._db.execute(
+                f"UPDATE jobs SET heartbeat = ? WHERE id IN ({marks}) AND status = 'running' AND worker = ?",
+                (time.time(), *job_ids, worker),
+            )
+
+    def stopped(self, worker: str, job_ids: list[int]) -> dict[int, str]:
+        if not job_ids:
+            return {}
+        marks = ",".join("?" * len(job_ids))
+        # A plain read: in WAL mode it never waits for a writer
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT id, status, worker FROM jobs WHERE id IN ({marks})", job_ids,
+            ).fetchall()
+        return {
+            job_id: status for job_id, status, owner in rows
+            if status != "running" or owner != worker
+        }
+
+    def finish(self, job_id: int, status: str, result: dict | None = None) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, updated = ? WHERE id = ? AND status = 'running'",
+                (status, json.dumps(result) if result is not None else None, time.time(), job_id),
+            )
+
+    def requeue(self, job_id: int, worker: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, updated = ?"
+                " WHERE id = ? AND status = 'running' AND worker = ?",
+                (time.time(), job_id, worker),
+            )
+
+    def recover(self, worker: str) -> int:
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET status = 'queued', updated = ? WHERE status = 'running' AND worker = ?",
+                (time.time(), worker),
+            )
+        return cursor.rowcount
+
+    def announce_bot(self) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('bot', ?)",
+                (f"{socket.gethostname()} {time.time():.0f}",),
+            )
+
+    def bot_seen(self) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM meta WHERE key = 'bot'").fetchone() is not None
+
+    def get(self, job_id: int) -> dict | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT user_id, kind, status, params, result FROM jobs WHERE id = ?", (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        user_id, kind, status, params, result = row
+        return {
+            "user_id": user_id,
+            "kind": kind,
+            "status": status,
+            "params": json.loads(params),
+            "result": json.loads(result) if result else None,
+        }
+
+    def cancel_user(self, user_id: int) -> tuple[int, list[dict]]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT status, params FROM jobs WHERE user_id = ? AND status IN ('queued', 'running')",
+                    (user_id,),
+                ).fetchall()
+                self._db.execute(
+                    "UPDATE jobs SET status = 'cancelled', updated = ?"
+                    " WHERE user_id = ? AND status IN ('queued', 'running')",
+                    (time.time(), user_id),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return len(rows), [json.loads(params) for status, params in rows if status == "queued"]
+
+
+work_queue = SqliteWorkQueue(JOB_QUEUE_DB)
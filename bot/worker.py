@@ -0,0 +1,250 @@
+"""Job worker: takes jobs from the queue, runs them and delivers the results.
+
+The bot runs one itself (BOT_WORKER_JOBS); more can run anywhere the queue
+file is reachable::
+
+    python -m bot.worker
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import signal
+import socket
+
+from telegram.ext import ExtBot
+
+from bot.config import (
+    BOT_TOKEN,
+    DOWNLOAD_DIR,
+    JOB_QUEUE_DB,
+    JOBS_PER_USER,
+    LOCAL_API_URL,
+    QUEUE_FILES_SET,
+    WORKER_JOBS,
+)
+from bot.downloader import start_workers, stop_workers
+from bot.file_cache import download_cache
+from bot.jobs import jobs
+from bot.ratelimit import PriorityRateLimiter
+from bot.tasks import run_job
+from bot.upload import bot_request
+from bot.webdav import webdav
+from bot.work_queue import WorkQueue, work_queue
+
+logger = logging.getLogger(__name__)
+
+# How often an idle worker looks for new jobs, and a busy one checks in for its running jobs
+_POLL_INTERVAL = 1.0
+_HEARTBEAT_INTERVAL = 2.0
+# How often running jobs are checked for a /cancel (or a takeover); a cheap read
+_CANCEL_POLL_INTERVAL = 0.5
+# Shutdown does not wait longer than this for the "will continue" notice
+_NOTIFY_TIMEOUT = 5.0
+# Held by the running worker of a download directory; a second one refuses to start
+_LOCK_FILE = "worker.lock"
+
+
+class Worker:
+    """Runs up to *max_jobs* queued jobs at once with *bot*, at most JOBS_PER_USER of one user.
+
+    Running jobs are checked in every couple of seconds and checked for a
+    /cancel twice a second; a job the user cancelled is stopped like an
+    in-process /cancel. Jobs still running at stop() go back to the queue
+    with their partial downloads kept. The name stays the same across
+    restarts (host and download directory), so the next start of this
+    worker resumes them, and those a crash interrupted.
+    Two live workers must never share a name, so a worker holds a lock file
+    in its download directory while it runs. Queue calls run in threads, so
+    a queue file locked by another process never stalls the event loop.
+    """
+
+    def __init__(self, bot, queue: WorkQueue, max_jobs: int) -> None:
+        self.name = f"{socket.gethostname()}:{os.path.abspath(DOWNLOAD_DIR)}"
+        self._bot = bot
+        self._queue = queue
+        self._free = asyncio.Semaphore(max(1, max_jobs))
+        self._running: dict[int, asyncio.Task] = {}  # job ID -> task
+        self._per_user: dict[int, int] = {}  # user ID -> running jobs
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self._lock_fd: int | None = None
+
+    def _lock(self) -> None:
+        """Take the download directory's lock file, or refuse to start if another worker holds it."""
+        path = os.path.join(DOWNLOAD_DIR, _LOCK_FILE)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            owner = os.pread(fd, 32, 0).decode(errors="replace").strip() or "?"
+            os.close(fd)
+            raise RuntimeError(
+                f"Worker {self.name} is already running (pid {owner}). Give this process its own "
+                f"DOWNLOAD_DIR, or set BOT_WORKER_JOBS=0 if the bot shares it with python -m bot.worker"
+            ) from None
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(os.getpid()).encode(), 0)
+        self._lock_fd = fd
+
+    async def start(self) -> None:
+        self._lock()
+        # This worker owns the download directory now, and with it the cache in there
+        download_cache.scan()
+        recovered = await asyncio.to_thread(self._queue.recover, self.name)
+        if recovered:
+            logger.info("Resuming %d jobs interrupted by a crash", recovered)
+        self._task = asyncio.create_task(self._claim_loop())
+        logger.info("Worker %s started", self.name)
+
+    async def stop(self) -> None:
+        self._stopping = True
+        download_cache.keep_partial()
+        tasks = list(self._running.values())
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def _claim_loop(self) -> None:
+        beat = asyncio.create_task(self._heartbeat())
+        watch = asyncio.create_task(self._watch())
+        try:
+            while True:
+                await self._free.acquire()
+                # One user's pile of jobs does not take all of this worker's slots
+                full = [user_id for user_id, count in self._per_user.items() if count >= JOBS_PER_USER]
+                try:
+                    job = await asyncio.to_thread(self._queue.claim, self.name, full)
+                except Exception:
+                    logger.warning("Claiming a job failed", exc_info=True)
+                    job = None
+                if job is None:
+                    self._free.release()
+                    await asyncio.sleep(_POLL_INTERVAL)
+                    continue
+                job_id, user_id, kind, params = job
+                logger.info("Job %d (%s) of user %d claimed", job_id, kind, user_id)
+                self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+                self._running[job_id] = asyncio.create_task(self._run(job_id, user_id, kind, params))
+        finally:
+            beat.cancel()
+            watch.cancel()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(_HEARTBEAT_INTERVAL)
+            try:
+                await asyncio.to_thread(self._queue.heartbeat, self.name, list(self._running))
+            except Exception:
+                logger.warning("Job heartbeat failed", exc_info=True)
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(_CANCEL_POLL_INTERVAL)
+            if not self._running:
+                continue
+            try:
+                stopped = await asyncio.to_thread(self._queue.stopped, self.name, list(self._running))
+            except Exception:
+                logger.warning("Checking jobs for cancellation failed", exc_info=True)
+                continue
+            for job_id, status in stopped.items():
+                task = self._running.get(job_id)
+                if task is None or task.cancelling():
+                    continue
+                if status == "cancelled":
+                    # Only this job: the user may have queued another one since the /cancel
+                    if not jobs.cancel_task(task):
+                        task.cancel()
+                else:
+                    # Presumed dead and given to another worker: let that one deliver
+                    logger.warning("Job %d was taken over by another worker", job_id)
+                    task.cancel()
+
+    async def _run(self, job_id: int, user_id: int, kind: str, params: dict) -> None:
+        try:
+            result = await run_job(self._bot, job_id, user_id, kind, params)
+        except asyncio.CancelledError:
+            if self._stopping:
+                await asyncio.to_thread(self._queue.requeue, job_id, self.name)
+                await self._notify_restart(params)
+            raise
+        except Exception:
+            logger.exception("Job %d (%s) failed", job_id, kind)
+            await asyncio.to_thread(self._queue.finish, job_id, "failed")
+        else:
+            await asyncio.to_thread(self._queue.finish, job_id, "done", result)
+        finally:
+            del self._running[job_id]
+            self._per_user[user_id] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
+            self._free.release()
+
+    async def _notify_restart(self, params: dict) -> None:
+        try:
+            await asyncio.wait_for(
+                self._bot.edit_message_text(
+                    "Бот перезапускается, задача продолжится после перезапуска.",
+                    chat_id=params["chat_id"], message_id=params["message_id"],
+                ),
+                _NOTIFY_TIMEOUT,
+            )
+        except Exception:
+            pass
+
+
+async def _serve() -> None:
+    local_api = {}
+    if LOCAL_API_URL:
+        local_api = {
+            "base_url": f"{LOCAL_API_URL}/bot",
+            "base_file_url": f"{LOCAL_API_URL}/file/bot",
+            "local_mode": True,
+        }
+    bot = ExtBot(BOT_TOKEN, request=bot_request(), rate_limiter=PriorityRateLimiter(), **local_api)
+    jobs.clean_up()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with bot:
+        start_workers()
+        worker = Worker(bot, work_queue, WORKER_JOBS)
+        await worker.start()
+        try:
+            await stop.wait()
+        finally:
+            logger.info("Worker %s stopping", worker.name)
+            await worker.stop()
+            stop_workers()
+            if webdav is not None:
+                await webdav.close()
+
+
+def main() -> None:
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    # The defaults inside DOWNLOAD_DIR would give this worker a queue of its own that nobody fills
+    if not QUEUE_FILES_SET:
+        raise ValueError("python -m bot.worker needs JOB_QUEUE_DB and FILE_ID_DB set to the files the bot uses")
+    if not work_queue.bot_seen():
+        raise ValueError(
+            f"No bot has used the job queue {JOB_QUEUE_DB}: set the bot's JOB_QUEUE_DB to the same file "
+            f"and start the bot first"
+        )
+    logger.info("Job queue: %s", JOB_QUEUE_DB)
+    asyncio.run(_serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,454 @@
+"""yt-dlp job runners: in-process (thread) and isolated worker processes.
+
+Worker processes run this module (``python -m bot.ytdl_workers``), not the
+bot's main module, and it imports nothing else of the bot: they start with
+yt-dlp only, without the bot's configuration, databases or caches.
+"""
+import asyncio
+import copy
+import json
+import logging
+import multiprocessing.connection
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Progress/postprocessor hook fields forwarded from worker processes
+_HOOK_KEYS = (
+    "status", "downloaded_bytes", "total_bytes", "total_bytes_estimate",
+    "speed", "eta", "postprocessor",
+)
+_POLL_INTERVAL = 0.5
+# Idle YoutubeDL instances kept per distinct option set
+_INSTANCES_PER_OPTIONS = 4
+# Streaming fetch: range size per request (YouTube throttles unranged reads) and read size
+_STREAM_CHUNK = 10 * 1024 * 1024
+_STREAM_READ = 256 * 1024
+_STREAM_RETRIES = 3
+# Worker processes import the bot package from where this process does
+_PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class WorkerCrashed(RuntimeError):
+    """The worker process died or stopped responding; it has been replaced."""
+
+
+class _JobHooks:
+    """Progress and postprocessor hooks of the job currently using a pooled instance.
+
+    Added once to each instance through yt-dlp's public hook API; borrow()
+    only points them at the next job's callbacks.
+    """
+
+    __slots__ = ("progress", "pp")
+
+    def __init__(self) -> None:
+        self.progress = None
+        self.pp = None
+
+    def on_progress(self, d: dict) -> None:
+        if self.progress is not None:
+            self.progress(d)
+
+    def on_pp(self, d: dict) -> None:
+        if self.pp is not None:
+            self.pp(d)
+
+
+class YdlPool:
+    """Reusable YoutubeDL instances, one free list per option set.
+
+    Building a YoutubeDL and its YouTube extractor costs tens of milliseconds,
+    and a reused extractor keeps its player-JS cache and HTTP connections.
+    ``outtmpl`` and the progress/postprocessor hooks are per-job overrides and
+    are not part of the option-set key. Per-instance counters (autonumber,
+    max_downloads) carry over between jobs, so option sets must not use them.
+    """
+
+    def __init__(self) -> None:
+        self._free: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(opts: dict) -> str:
+        return json.dumps(opts, sort_keys=True, default=str)
+
+    @staticmethod
+    def _create(opts: dict):
+        import yt_dlp
+
+        ydl = yt_dlp.YoutubeDL(opts)
+        ydl._pool_outtmpl = copy.deepcopy(ydl.params["outtmpl"])
+        ydl._pool_hooks = _JobHooks()
+        ydl.add_progress_hook(ydl._pool_hooks.on_progress)
+        ydl.add_postprocessor_hook(ydl._pool_hooks.on_pp)
+        ydl.get_info_extractor("Youtube")
+        return ydl
+
+    def warm(self, opts: dict) -> None:
+        """Import yt-dlp and build one instance for *opts* ahead of the first job."""
+        ydl = self._create(opts)
+        with self._lock:
+            self._free.setdefault(self._key(opts), []).append(ydl)
+
+    @contextmanager
+    def borrow(self, opts: dict, progress_hook=None, pp_hook=None):
+        """Yield a YoutubeDL configured with *opts*, its hooks and outtmpl applied."""
+        opts = dict(opts)
+        outtmpl = opts.pop("outtmpl", None)
+        opts.pop("progress_hooks", None)
+        key = self._key(opts)
+
+        with self._lock:
+            free = self._free.get(key)
+            ydl = free.pop() if free else None
+        if ydl is None:
+            ydl = self._create(opts)
+
+        ydl.params["outtmpl"] = copy.deepcopy(ydl._pool_outtmpl)
+        if outtmpl:
+            ydl.params["outtmpl"]["default"] = outtmpl
+        hooks = ydl._pool_hooks
+        hooks.progress, hooks.pp = progress_hook, pp_hook
+        try:
+            yield ydl
+        finally:
+            hooks.progress = hooks.pp = None
+            with self._lock:
+                free = self._free.setdefault(key, [])
+                if len(free) < _INSTANCES_PER_OPTIONS:
+                    free.append(ydl)
+                    ydl = None
+            if ydl is not None:
+                ydl.close()
+
+
+# One pool per process; worker processes get their own copy
+ydl_pool = YdlPool()
+
+
+def process_info(ydl, info: dict) -> dict:
+    """Download from an already-resolved info dict, re-extracting if its URLs went stale."""
+    import yt_dlp
+
+    try:
+        return ydl.process_ie_result(copy.deepcopy(info), download=True)
+    except yt_dlp.utils.DownloadError as e:
+        webpage_url = info.get("webpage_url")
+        if not webpage_url:
+            raise
+        logger.warning("Download from resolved info failed (%s), re-extracting", e)
+        return ydl.extract_info(webpage_url)
+
+
+def run_extract(opts: dict, url: str) -> dict:
+    """Extract metadata for *url*; returns a sanitized, cacheable info dict."""
+    with ydl_pool.borrow(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+        return ydl.sanitize_info(info, remove_private_keys=True)
+
+
+def run_download(opts: dict, info: dict, progress_hook=None, pp_hook=None) -> dict:
+    """Download *info* with *opts*; returns the sanitized result info dict."""
+    with ydl_pool.borrow(opts, progress_hook, pp_hook) as ydl:
+        return ydl.sanitize_info(process_info(ydl, info))
+
+
+def pick_stream_format(info: dict) -> dict | None:
+    """Best audio-only format that can be fetched with plain HTTP range requests."""
+    audio = [
+        f for f in info.get("formats") or []
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")
+        and f.get("protocol") in ("http", "https") and f.get("url")
+    ]
+    return max(audio, key=lambda f: f.get("abr") or f.get("tbr") or 0, default=None)
+
+
+def run_stream(
+    opts: dict, info: dict, fmt: dict, ffmpeg_args: list[str], outtmpl: str,
+    progress_hook=None, abort=None,
+) -> str:
+    """Fetch *fmt* in ranged chunks and pipe the bytes into ffmpeg as they arrive.
+
+    *ffmpeg_args* is an ffmpeg command reading ``pipe:0``, without the output
+    path; the output name comes from *outtmpl*. Nothing but the encoded file is
+    written to disk. Progress is reported through *progress_hook* in yt-dlp's
+    format. Returns the output path.
+    """
+    from yt_dlp.networking import Request
+
+    # Only an exact size bounds the ranges; otherwise the first Content-Range tells it
+    total = fmt.get("filesize")
+    downloaded = 0
+    started = time.monotonic()
+
+    with ydl_pool.borrow(opts) as ydl:
+        out_path = ydl.prepare_filename(info, outtmpl=outtmpl)
+        proc = subprocess.Popen(
+            [*ffmpeg_args, out_path], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        stderr_tail = deque(maxlen=20)
+        drain = threading.Thread(target=lambda: stderr_tail.extend(proc.stderr), daemon=True)
+        drain.start()
+
+        def fetch() -> bool:
+            """Pipe one range starting at ``downloaded``; returns True at the end of the file."""
+            nonlocal total, downloaded
+            start = downloaded
+            end = start + _STREAM_CHUNK - 1
+            if total:
+                end = min(end, total - 1)
+            headers = dict(fmt.get("http_headers") or {}, Range=f"bytes={start}-{end}")
+            written = 0
+            with ydl.urlopen(Request(fmt["url"], headers=headers)) as response:
+                if response.status == 200 and start:
+                    raise RuntimeError("server ignored the range request")
+                content_range = response.headers.get("Content-Range", "")
+                if not total and "/" in content_range and not content_range.endswith("/*"):
+                    total = int(content_range.rsplit("/", 1)[1])
+                while True:
+                    if abort is not None and abort.is_set():
+                        raise RuntimeError("stream aborted")
+                    data = response.read(_STREAM_READ)
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+                    written += len(data)
+                    downloaded += len(data)
+                    if progress_hook:
+                        elapsed = time.monotonic() - started
+                        progress_hook({
+                            "status": "downloading",
+                            "downloaded_bytes": downloaded,
+                            "total_bytes": total,
+                            "speed": downloaded / elapsed if elapsed else None,
+                        })
+                # 200 instead of 206 means the server sent the whole file
+                whole = response.status == 200
+            return bool(whole or written < end - start + 1 or (total and downloaded >= total))
+
+        try:
+            failures = 0
+            while True:
+                try:
+                    done = fetch()
+                except BrokenPipeError:
+                    # ffmpeg exited early; its exit code and stderr explain why
+                    break
+                except RuntimeError:
+                    raise
+                except Exception as e:
+                    # Bytes already piped stay piped: resume from where the range broke off
+                    failures += 1
+                    if failures > _STREAM_RETRIES:
+                        raise
+                    logger.warning("Stream chunk at %d failed (%s), retrying", downloaded, e)
+                    time.sleep(failures)
+                    continue
+                if done:
+                    break
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            proc.wait()
+            drain.join(timeout=5)
+            if proc.returncode != 0:
+                tail = b"".join(stderr_tail).decode(errors="replace")
+                raise RuntimeError(f"ffmpeg exit code {proc.returncode}: {tail[-300:]}")
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            raise
+    return out_path
+
+
+def _worker_main(conn) -> None:
+    """Worker process loop: receive (kind, args), stream hook events, send the result.
+
+    The first message is the option set to pre-build an instance for (or None).
+    """
+    try:
+        warm_opts = conn.recv()
+    except (EOFError, KeyboardInterrupt):
+        return
+    if warm_opts is not None:
+        ydl_pool.warm(warm_opts)
+
+    def forward(event: str):
+        def hook(d):
+            conn.send((event, {k: d.get(k) for k in _HOOK_KEYS}))
+        return hook
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        kind, args = job
+        try:
+            if kind == "extract":
+                result = run_extract(*args)
+            elif kind == "stream":
+                result = run_stream(*args, progress_hook=forward("progress"))
+            else:
+                result = run_download(*args, progress_hook=forward("progress"), pp_hook=forward("pp"))
+            conn.send(("result", result))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    """A worker process and the connection to it (a socket pair; the child gets its end by fd)."""
+
+    def __init__(self, warm_opts: dict | None) -> None:
+        parent_sock, child_sock = socket.socketpair()
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [_PACKAGE_PARENT, env.get("PYTHONPATH")]))
+        with parent_sock, child_sock:
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "bot.ytdl_workers", str(child_sock.fileno())],
+                pass_fds=(child_sock.fileno(),), env=env,
+            )
+            self.conn = multiprocessing.connection.Connection(parent_sock.detach())
+        self.conn.send(warm_opts)
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def kill(self) -> None:
+        if self.is_alive():
+            self.process.kill()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+        self.conn.close()
+
+
+class YtdlProcessPool:
+    """Runs yt-dlp jobs in long-lived worker processes, away from the bot's GIL.
+
+    Hook events travel back over a pipe and are replayed on a parent thread.
+    A worker that dies, or sends nothing for ``hang_timeout`` seconds, is
+    killed and replaced; only its job fails.
+    """
+
+    def __init__(self, size: int, hang_timeout: float, warm_opts: dict | None = None) -> None:
+        self._warm_opts = warm_opts
+        self._size = size
+        self._hang_timeout = hang_timeout
+        self._idle: list[_Worker] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def warm_up(self) -> None:
+        """Start all workers now so the first job does not pay the spawn cost."""
+        with self._lock:
+            while len(self._idle) < self._size:
+                self._idle.append(_Worker(self._warm_opts))
+
+    def _checkout(self) -> _Worker:
+        self._slots.acquire()
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.is_alive():
+                    return worker
+                worker.kill()
+        return _Worker(self._warm_opts)
+
+    def _checkin(self, worker: _Worker | None) -> None:
+        if worker is not None:
+            with self._lock:
+                self._idle.append(worker)
+        self._slots.release()
+
+    def run_job(self, kind: str, args: tuple, progress_hook=None, pp_hook=None, abort=None) -> dict:
+        """Blocking: run one job in a worker. Call from a thread, not the event loop.
+
+        *abort* is an optional threading.Event; setting it kills the worker.
+        """
+        worker = self._checkout()
+        healthy = False
+        try:
+            try:
+                worker.conn.send((kind, args))
+            except OSError:
+                # Idle worker died since checkout; the job has not started yet
+                worker.kill()
+                worker = _Worker(self._warm_opts)
+                worker.conn.send((kind, args))
+            last_event = time.monotonic()
+            while True:
+                if abort is not None and abort.is_set():
+                    raise WorkerCrashed("job aborted")
+                if not worker.conn.poll(_POLL_INTERVAL):
+                    if not worker.is_alive():
+                        raise WorkerCrashed(f"worker exited with code {worker.process.returncode}")
+                    if time.monotonic() - last_event > self._hang_timeout:
+                        raise WorkerCrashed(f"worker silent for {self._hang_timeout:.0f} s")
+                    continue
+                try:
+                    event, payload = worker.conn.recv()
+                except (EOFError, OSError):
+                    raise WorkerCrashed("worker pipe closed") from None
+                last_event = time.monotonic()
+                if event == "progress" and progress_hook:
+                    progress_hook(payload)
+                elif event == "pp" and pp_hook:
+                    pp_hook(payload)
+                elif event == "result":
+                    healthy = True
+                    return payload
+                elif event == "error":
+                    healthy = True
+                    raise RuntimeError(payload)
+        except WorkerCrashed as e:
+            logger.warning("yt-dlp worker %s replaced: %s", worker.process.pid, e)
+            raise
+        finally:
+            if not healthy:
+                # Mid-job: the worker state is unknown, so never reuse it
+                worker.kill()
+            self._checkin(worker if healthy else None)
+
+    async def run(self, executor, kind: str, args: tuple, progress_hook=None, pp_hook=None) -> dict:
+        """Run a job from the event loop; cancelling the awaiting task kills its worker."""
+        abort = threading.Event()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            executor, self.run_job, kind, args, progress_hook, pp_hook, abort
+        )
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            abort.set()
+            # The thread finishes with WorkerCrashed once the worker is killed
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for worker in self._idle:
+                try:
+                    worker.conn.send(None)
+                except OSError:
+                    pass
+                worker.kill()
+            self._idle.clear()
+
+
+if __name__ == "__main__":
+    _worker_main(multiprocessing.connection.Connection(int(sys.argv[1])))
@@ -0,0 +1,103 @@
+"""Local Bot API stand-in for testing the bot offline.
+
+Answers every method the way the Bot API does for a successful call: getMe
+with the bot's user, send and edit methods with the message they would
+produce, anything else with ``true``. Calls are recorded, served from a
+background thread on 127.0.0.1.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 123, "is_bot": True, "first_name": "Test", "username": "test_bot"}
+
+
+class FakeBotApi:
+    """Bot API server; use as a context manager, pass ``url`` as the bot's API server.
+
+    ``calls`` holds (method, parameters) of every request; form parameters
+    arrive as strings, as the Bot API gets them.
+    """
+
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, dict]] = []
+        self._called = threading.Condition()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def wait_for(self, method: str, timeout: float = 10) -> dict:
+        """Parameters of the first *method* call, waiting up to *timeout* seconds for it."""
+        deadline = time.monotonic() + timeout
+        with self._called:
+            while True:
+                for name, params in self.calls:
+                    if name == method:
+                        return params
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError(f"{method} was not called")
+                self._called.wait(left)
+
+    def _record(self, method: str, params: dict) -> None:
+        with self._called:
+            self.calls.append((method, params))
+            self._called.notify_all()
+
+    def __enter__(self) -> "FakeBotApi":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _result(method: str, params: dict):
+    if method == "getMe":
+        return BOT_USER
+    if method.startswith("send") or method.startswith("edit"):
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": int(params.get("message_id", 1)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+    return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        # /bot<token>/<method>
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            params = json.loads(body or b"{}")
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            params = dict(parse_qsl(body.decode()))
+        else:
+            params = {}
+        self.server.fake._record(method, params)
+
+        reply = json.dumps({"ok": True, "result": _result(method, params)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
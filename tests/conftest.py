@@ -0,0 +1,7 @@
+"""Minimal settings so bot modules import without a .env."""
+import os
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ.setdefault("DOWNLOAD_DIR", tempfile.mkdtemp(prefix="yt_downloads_test_"))
+os.environ.setdefault("YANDEX_DISK_PATH", os.path.join(os.environ["DOWNLOAD_DIR"], "disk"))
@@ -0,0 +1,138 @@
+"""WebDavUploader against the local WebDAV stand-in."""
+import asyncio
+import os
+
+import pytest
+
+from bot.webdav import WebDavUploader
+from tests.webdav_server import FakeWebDav
+
+CHUNK = 64 * 1024
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(os.urandom(5 * CHUNK + 123))
+    return str(path)
+
+
+def _uploader(server: FakeWebDav) -> WebDavUploader:
+    return WebDavUploader(server.url, "", "", "/Downloads", 2, CHUNK)
+
+
+def _upload(server: FakeWebDav, *files: str) -> list[str]:
+    async def run():
+        uploader = _uploader(server)
+        try:
+            return await asyncio.gather(*(uploader.upload(f, "Video") for f in files))
+        finally:
+            await uploader.close()
+
+    return asyncio.run(run())
+
+
+def _interrupt(server: FakeWebDav, file: str, after_puts: int) -> None:
+    """Stop an upload of *file* after *after_puts* PUTs, the way a restart does: its task is cancelled."""
+    server.stall_after = after_puts
+
+    async def run():
+        uploader = _uploader(server)
+        task = asyncio.create_task(uploader.upload(file, "Video"))
+        await asyncio.to_thread(server.stalled.wait, 10)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await uploader.close()
+
+    asyncio.run(run())
+    server.stall_after = None
+    server.release()
+
+
+def _content(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_ranged_upload(source):
+    with FakeWebDav() as server:
+        [remote] = _upload(server, source)
+    assert remote == "/Downloads/Video/video.mp4"
+    assert server.files[remote] == _content(source)
+    assert [p for p in server.files if p.endswith(".part")] == []
+    assert len(server.puts) == 6
+    assert all(content_range for _, content_range, _ in server.puts)
+
+
+def test_small_file_is_one_put(tmp_path):
+    path = tmp_path / "audio.mp3"
+    path.write_bytes(b"x" * 1000)
+    with FakeWebDav() as server:
+        [remote] = _upload(server, str(path))
+    assert server.files[remote] == b"x" * 1000
+    assert [content_range for _, content_range, _ in server.puts] == [None]
+
+
+@pytest.mark.parametrize("ranges", ["reject", "ignore"])
+def test_server_without_ranges_gets_whole_file(source, ranges):
+    with FakeWebDav(ranges) as server:
+        [remote] = _upload(server, source)
+    assert server.files[remote] == _content(source)
+    _, content_range, size = server.puts[-1]
+    assert content_range is None and size == os.path.getsize(source)
+
+
+def test_dropped_connection_resumes(source):
+    with FakeWebDav() as server:
+        # Two ranges arrive, the third is cut off halfway
+        server.cut = (2, CHUNK // 2)
+        [remote] = _upload(server, source)
+    assert server.files[remote] == _content(source)
+    # The cut range is sent again; the two before it are not
+    starts = [int(r.split()[1].split("-")[0]) for _, r, _ in server.puts]
+    assert starts == [0, CHUNK, 2 * CHUNK, 2 * CHUNK, 3 * CHUNK, 4 * CHUNK, 5 * CHUNK]
+
+
+def test_upload_cut_off_by_restart_resumes(source):
+    with FakeWebDav() as server:
+        _interrupt(server, source, after_puts=2)
+        assert [p for p in server.files if p.endswith(".part")]
+
+        # A new process (a new uploader) picks up the same part
+        before = len(server.puts)
+        [remote] = _upload(server, source)
+    assert server.files[remote] == _content(source)
+    assert [p for p in server.files if p.endswith(".part")] == []
+    assert sum(size for _, _, size in server.puts[before:]) == os.path.getsize(source) - 2 * CHUNK
+
+
+def test_changed_source_starts_over(source):
+    with FakeWebDav() as server:
+        _interrupt(server, source, after_puts=2)
+        with open(source, "r+b") as f:
+            f.write(b"changed")
+        os.utime(source, ns=(1, 1))
+
+        before = len(server.puts)
+        [remote] = _upload(server, source)
+    assert server.files[remote] == _content(source)
+    assert sum(size for _, _, size in server.puts[before:]) == os.path.getsize(source)
+
+
+def test_name_collisions(source, tmp_path):
+    other = tmp_path / "other" / "video.mp4"
+    other.parent.mkdir()
+    other.write_bytes(b"other")
+    with FakeWebDav() as server:
+        server.dirs.update({"/Downloads", "/Downloads/Video"})
+        server.files["/Downloads/Video/video.mp4"] = bytearray(b"already there")
+        remotes = _upload(server, source, str(other), source)
+    assert sorted(remotes) == [
+        "/Downloads/Video/video (1).mp4",
+        "/Downloads/Video/video (2).mp4",
+        "/Downloads/Video/video (3).mp4",
+    ]
+    assert server.files["/Downloads/Video/video.mp4"] == b"already there"
+    contents = sorted(bytes(server.files[r]) for r in remotes)
+    assert contents == sorted([_content(source), _content(source), b"other"])
+    assert [p for p in server.files if p.endswith(".part")] == []
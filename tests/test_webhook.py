@@ -0,0 +1,75 @@
+"""The bot in webhook mode against the local Bot API stand-in."""
+import asyncio
+import socket
+
+import httpx
+
+from bot.main import build_application
+from tests.bot_api_server import FakeBotApi
+
+SECRET = "s3cret"
+START = {
+    "update_id": 1,
+    "message": {
+        "message_id": 10,
+        "date": 0,
+        "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "User"},
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _post_updates(api: FakeBotApi, *secrets: str) -> list[int]:
+    """Run the bot's webhook, POST /start once per secret; returns the status codes."""
+    port = _free_port()
+    webhook = f"http://127.0.0.1:{port}/telegram"
+
+    async def run():
+        application = build_application(api.url)
+        async with application:
+            await application.start()
+            await application.updater.start_webhook(
+                listen="127.0.0.1", port=port, url_path="telegram", webhook_url=webhook, secret_token=SECRET,
+            )
+            try:
+                async with httpx.AsyncClient() as client:
+                    statuses = []
+                    for secret in secrets:
+                        response = await client.post(
+                            webhook, json=START, headers={"X-Telegram-Bot-Api-Secret-Token": secret},
+                        )
+                        statuses.append(response.status_code)
+                # The update is handled after the webhook has answered
+                if 200 in statuses:
+                    await asyncio.to_thread(api.wait_for, "sendMessage")
+                return statuses
+            finally:
+                await application.updater.stop()
+                await application.stop()
+
+    return asyncio.run(run())
+
+
+def test_webhook_update_is_answered():
+    with FakeBotApi() as api:
+        assert _post_updates(api, SECRET) == [200]
+    webhook = api.wait_for("setWebhook", 0)
+    assert webhook["url"].endswith("/telegram")
+    assert webhook["secret_token"] == SECRET
+    reply = api.wait_for("sendMessage", 0)
+    assert reply["chat_id"] == "42"
+    assert reply["text"].startswith("Привет!")
+
+
+def test_webhook_rejects_wrong_secret():
+    with FakeBotApi() as api:
+        assert _post_updates(api, "wrong") == [403]
+    assert "sendMessage" not in [method for method, _ in api.calls]
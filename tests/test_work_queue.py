@@ -0,0 +1,127 @@
+"""SqliteWorkQueue on a temporary sqlite file, with a clock the tests move."""
+import pytest
+
+from bot import work_queue as work_queue_module
+from bot.work_queue import _MAX_ATTEMPTS, _STALE_AFTER, SqliteWorkQueue
+
+AGING = 1.0
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(work_queue_module, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    return SqliteWorkQueue(str(tmp_path / "jobs.sqlite3"), aging=AGING)
+
+
+def _claim(queue: SqliteWorkQueue, worker: str = "a", skip_users=()) -> int | None:
+    job = queue.claim(worker, skip_users)
+    return job[0] if job else None
+
+
+def test_cheapest_job_first(queue):
+    slow = queue.put(1, "video", {"n": 1}, cost=100)
+    fast = queue.put(2, "audio", {"n": 2}, cost=10)
+    assert queue.claim("a") == (fast, 2, "audio", {"n": 2})
+    assert _claim(queue) == slow
+    assert _claim(queue) is None
+
+
+def test_waiting_jobs_age_past_cheaper_ones(queue, clock):
+    old = queue.put(1, "video", {}, cost=50)
+    clock.now += 100
+    # Cheaper, but the old job has waited 100 s, worth 100 s of cost at AGING 1
+    new = queue.put(2, "video", {}, cost=5)
+    assert queue.ahead(5) == 2
+    assert queue.ahead(0) == 1
+    assert [_claim(queue), _claim(queue)] == [old, new]
+
+
+def test_full_users_are_skipped(queue):
+    busy = queue.put(1, "video", {}, cost=1)
+    other = queue.put(2, "video", {}, cost=100)
+    assert _claim(queue, skip_users=[1]) == other
+    assert _claim(queue, skip_users=[1]) is None
+    assert _claim(queue) == busy
+
+
+def test_interrupted_job_goes_back_to_its_worker(queue, clock):
+    job = queue.put(1, "video", {}, cost=100)
+    assert _claim(queue, "a") == job
+    queue.requeue(job, "a")
+    cheaper = queue.put(2, "video", {}, cost=1)
+
+    # Its worker has the partial download: it gets the job back first, and nobody else does
+    assert _claim(queue, "b") == cheaper
+    assert _claim(queue, "b") is None
+    assert _claim(queue, "a") == job
+
+
+def test_interrupted_job_is_given_away_after_stale_after(queue, clock):
+    job = queue.put(1, "video", {})
+    assert _claim(queue, "a") == job
+    queue.requeue(job, "a")
+    clock.now += _STALE_AFTER - 1
+    assert _claim(queue, "b") is None
+    clock.now += 2
+    assert _claim(queue, "b") == job
+
+
+def test_running_job_without_heartbeat_is_taken_over(queue, clock):
+    job = queue.put(1, "video", {})
+    assert _claim(queue, "a") == job
+    clock.now += _STALE_AFTER - 1
+    queue.heartbeat("a", [job])
+    clock.now += _STALE_AFTER - 1
+    assert _claim(queue, "b") is None
+    assert queue.stopped("a", [job]) == {}
+
+    clock.now += 2
+    assert _claim(queue, "b") == job
+    assert queue.stopped("a", [job]) == {job: "running"}
+    assert queue.stopped("b", [job]) == {}
+
+
+def test_job_that_keeps_losing_its_worker_is_given_up(queue, clock):
+    job = queue.put(1, "video", {})
+    for attempt in range(_MAX_ATTEMPTS):
+        assert _claim(queue, f"w{attempt}") == job
+        clock.now += _STALE_AFTER + 1
+    assert _claim(queue, "last") is None
+    assert queue.get(job)["status"] == "failed"
+
+
+def test_cancel_user(queue):
+    running = queue.put(1, "video", {"message_id": 10})
+    waiting = queue.put(1, "audio", {"message_id": 11})
+    other = queue.put(2, "video", {"message_id": 12})
+    assert _claim(queue, "a", skip_users=[2]) == running
+
+    assert queue.cancel_user(1) == (2, [{"message_id": 11}])
+    assert queue.get(waiting)["status"] == "cancelled"
+    # The running one is stopped by its worker, which then cannot record a result
+    assert queue.stopped("a", [running]) == {running: "cancelled"}
+    queue.finish(running, "done", {"file": "x"})
+    assert queue.get(running)["status"] == "cancelled"
+
+    assert _claim(queue, "a") == other
+    assert queue.cancel_user(1) == (0, [])
+
+
+def test_workers_find_the_bot(queue):
+    assert not queue.bot_seen()
+    queue.announce_bot()
+    assert queue.bot_seen()
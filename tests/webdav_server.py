@@ -0,0 +1,145 @@
+"""Local WebDAV stand-in for testing the uploader offline.
+
+Implements what bot/webdav.py uses (MKCOL, HEAD, PUT with or without
+Content-Range, MOVE, DELETE) on an in-memory tree, served from a background
+thread on 127.0.0.1.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+
+class FakeWebDav:
+    """In-memory WebDAV server; use as a context manager, upload to ``url``.
+
+    *ranges* is how ranged PUTs are handled: ``"accept"`` writes the body at
+    its offset, ``"reject"`` answers 501, ``"ignore"`` stores the body as the
+    whole file (as servers without range support do).
+
+    Faults: ``cut = (n, size)`` drops the connection of the n-th PUT (from 0)
+    after *size* body bytes and keeps nothing of it; ``stall_after`` lets that
+    many PUTs through, then holds every further one until release() and drops
+    it, as a bot stopped mid-upload would.
+    """
+
+    def __init__(self, ranges: str = "accept") -> None:
+        self.ranges = ranges
+        self.files: dict[str, bytearray] = {}
+        self.dirs: set[str] = {"/"}
+        # (path, Content-Range or None, body bytes received) of every PUT
+        self.puts: list[tuple[str, str | None, int]] = []
+        self.cut: tuple[int, int] | None = None
+        self.stall_after: int | None = None
+        self.stalled = threading.Event()
+        self._release = threading.Event()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def release(self) -> None:
+        self._release.set()
+
+    def __enter__(self) -> "FakeWebDav":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    @property
+    def fake(self) -> FakeWebDav:
+        return self.server.fake
+
+    def _path(self, url: str | None = None) -> str:
+        return unquote(urlsplit(url or self.path).path).rstrip("/") or "/"
+
+    def _reply(self, status: int, length: int = 0) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def do_MKCOL(self) -> None:
+        path = self._path()
+        with self.fake._lock:
+            if path in self.fake.dirs or path in self.fake.files:
+                return self._reply(405)
+            if (path.rsplit("/", 1)[0] or "/") not in self.fake.dirs:
+                return self._reply(409)
+            self.fake.dirs.add(path)
+        self._reply(201)
+
+    def do_HEAD(self) -> None:
+        path = self._path()
+        with self.fake._lock:
+            if path in self.fake.dirs:
+                return self._reply(200)
+            data = self.fake.files.get(path)
+        if data is None:
+            return self._reply(404)
+        self._reply(200, len(data))
+
+    def do_DELETE(self) -> None:
+        with self.fake._lock:
+            found = self.fake.files.pop(self._path(), None) is not None
+        self._reply(204 if found else 404)
+
+    def do_MOVE(self) -> None:
+        src, dst = self._path(), self._path(self.headers["Destination"])
+        with self.fake._lock:
+            if src not in self.fake.files:
+                return self._reply(404)
+            if dst in self.fake.files and self.headers.get("Overwrite") == "F":
+                return self._reply(412)
+            self.fake.files[dst] = self.fake.files.pop(src)
+        self._reply(201)
+
+    def do_PUT(self) -> None:
+        fake = self.fake
+        path = self._path()
+        content_range = self.headers.get("Content-Range")
+        length = int(self.headers["Content-Length"])
+
+        with fake._lock:
+            stall = fake.stall_after is not None and len(fake.puts) >= fake.stall_after
+            cut = fake.cut[1] if fake.cut and fake.cut[0] == len(fake.puts) else None
+        if stall:
+            fake.stalled.set()
+            fake._release.wait(10)
+            self.close_connection = True
+            return
+
+        body = self.rfile.read(min(length, cut)) if cut is not None else self.rfile.read(length)
+        with fake._lock:
+            fake.puts.append((path, content_range, len(body)))
+        if cut is not None and cut < length:
+            self.close_connection = True
+            return
+
+        if content_range and fake.ranges == "reject":
+            return self._reply(501)
+        with fake._lock:
+            if content_range and fake.ranges == "accept":
+                start = int(content_range.split()[1].split("-")[0])
+                data = fake.files.setdefault(path, bytearray())
+                if start > len(data):
+                    return self._reply(416)
+                data[start:start + len(body)] = body
+            else:
+                fake.files[path] = bytearray(body)
+        self._reply(201)